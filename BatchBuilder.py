@@ -0,0 +1,86 @@
+import glob
+import logging
+import os.path
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import cv2
+from ImageBuilder import ImageBuilder
+
+
+def CollectInputs(pattern: str) -> list:
+    if os.path.isdir(pattern):
+        files = [os.path.join(pattern, f) for f in os.listdir(pattern)]
+    else:
+        files = glob.glob(pattern)
+    return sorted(f for f in files if os.path.isfile(f))
+
+
+class BatchBuilder:
+    def __init__(self, builder: ImageBuilder, threads: int = 4):
+        self.Builder = builder
+        self.Threads = threads
+        self.Failed = 0
+
+    def Build(self, inputs: list, outputDir: str) -> float:
+        if not os.path.isdir(outputDir):
+            os.makedirs(outputDir)
+        logging.info("Generating " + str(len(inputs)) + " normal maps into " + outputDir)
+
+        start = time.perf_counter()
+        done = 0
+        self.Failed = 0
+        # decoding and encoding run on the pool while the model works on the current image
+        with ThreadPoolExecutor(self.Threads) as pool:
+            decoding = {}
+            encoding = []
+            ahead = self.Threads * 2
+            for i in range(min(ahead, len(inputs))):
+                decoding[i] = pool.submit(ImageBuilder.ReadInputImage, inputs[i])
+            for i, path in enumerate(inputs):
+                if i + ahead < len(inputs):
+                    decoding[i + ahead] = pool.submit(ImageBuilder.ReadInputImage, inputs[i + ahead])
+                try:
+                    self.Builder.InputImage = decoding.pop(i).result()
+                except ValueError as e:
+                    logging.error(e)
+                    self.Failed += 1
+                    continue
+                outputPath = os.path.join(outputDir, os.path.splitext(os.path.basename(path))[0] + ".png")
+                key = self.Builder.CacheKey()
+                if key is not None and self.Builder.Cache.Get(key, outputPath):
+                    done += 1
+                    continue
+                rebuilt = self.Builder.BuildFullImage()
+                encoding.append(pool.submit(self.Encode, outputPath, rebuilt, key))
+                # an image only counts as done once it is written
+                finished = [f for f in encoding if f.done()]
+                encoding = [f for f in encoding if not f.done()]
+                done += self.Collect(finished)
+            done += self.Collect(encoding)
+
+        elapsed = time.perf_counter() - start
+        speed = done / elapsed if elapsed > 0 else 0.0
+        logging.info("Generated {0} normal maps in {1:.2f}s ({2:.2f} images/s)".format(done, elapsed, speed))
+        print("Generated {0} normal maps in {1:.2f}s ({2:.2f} images/s)".format(done, elapsed, speed))
+        if self.Failed > 0:
+            logging.error(str(self.Failed) + " normal maps could not be generated")
+            print(str(self.Failed) + " normal maps could not be generated")
+        return speed
+
+    def Collect(self, futures: list) -> int:
+        written = 0
+        for f in futures:
+            try:
+                f.result()
+                written += 1
+            except (ValueError, OSError, cv2.error) as e:
+                logging.error(e)
+                self.Failed += 1
+        return written
+
+    def Encode(self, outputPath: str, image, key: str):
+        if not cv2.imwrite(outputPath, image):
+            raise ValueError(outputPath + " cannot be written!")
+        if key is not None:
+            self.Builder.Cache.Put(key, outputPath)
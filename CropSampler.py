@@ -0,0 +1,121 @@
+import logging
+import math
+import os.path
+import numpy as np
+from keras.utils import Sequence
+from ImageProcessor import ImageProcessor
+from Tracing import Trace
+
+
+def TransformNormals(normal: np.ndarray, flip: bool, rotations: int, greenUp: bool = True) -> np.ndarray:
+    # the channels are BGR, so x is in red and y in green, the tangent components have to follow the pixels
+    x = normal[:, :, 2]
+    y = normal[:, :, 1] if greenUp else 255 - normal[:, :, 1]
+    if flip:
+        x = 255 - x
+    for _ in range(rotations):
+        # a counterclockwise quarter turn maps (x, y) to (-y, x) in a y-up frame
+        x, y = 255 - y, x
+    if not greenUp:
+        y = 255 - y
+    return np.stack([normal[:, :, 0], y, x], axis=2)
+
+
+def TransformPair(rgb: np.ndarray, normal: np.ndarray, flip: bool, rotations: int, greenUp: bool = True):
+    if flip:
+        rgb = rgb[:, ::-1]
+        normal = normal[:, ::-1]
+    rgb = np.rot90(rgb, rotations)
+    normal = np.rot90(normal, rotations)
+    return rgb, TransformNormals(normal, flip, rotations, greenUp)
+
+
+class CropSampler:
+    def __init__(self, rgbPath: str, normalPath: str, imageSize: int, imageCount: int = 1000, training: bool = True,
+                 testPercent: float = 0.2, augment: bool = True, greenUp: bool = True, seed: int = 0):
+        self.RGBPath = rgbPath
+        self.NormalPath = normalPath
+        self.ImageSize = imageSize
+        self.ImageCount = imageCount
+        self.Training = training
+        self.TestPercent = testPercent
+        self.Augment = augment and training
+        self.GreenUp = greenUp
+        self.Seed = seed
+        self.Pairs = []
+        self.Weights = None
+        self.Streaming = True
+        self.IsLoaded = False
+
+    def Load(self):
+        names = sorted(set(os.listdir(self.RGBPath)) & set(os.listdir(self.NormalPath)))
+        # whole sources are held out for testing, so no testing crop overlaps a training crop
+        order = np.random.default_rng(self.Seed).permutation(len(names))
+        testCount = int(np.floor(len(names) * self.TestPercent))
+        selected = order[testCount:] if self.Training else order[:testCount]
+        if selected.shape[0] == 0:
+            raise ValueError("No " + ("training" if self.Training else "testing") + " sources in " + self.RGBPath)
+
+        with Trace.Span("decode", items=selected.shape[0]) as span:
+            for i in np.sort(selected):
+                rgbImg, normalImg = ImageProcessor.LoadPair(os.path.join(self.RGBPath, names[i]),
+                                                            os.path.join(self.NormalPath, names[i]))
+                if rgbImg.shape[0] < self.ImageSize or rgbImg.shape[1] < self.ImageSize:
+                    logging.error(names[i] + " is smaller than the crop size, skipping it")
+                    continue
+                self.Pairs.append((rgbImg, normalImg))
+                span.Add("bytesRead", rgbImg.nbytes + normalImg.nbytes)
+
+        # sources are picked by their number of crop positions, so every position is equally likely
+        positions = np.array([(p[0].shape[0] - self.ImageSize + 1) * (p[0].shape[1] - self.ImageSize + 1)
+                              for p in self.Pairs], dtype=np.float64)
+        self.Weights = positions / positions.sum()
+        self.IsLoaded = True
+        logging.info("Sampling crops of size " + str(self.ImageSize) + " from " + str(len(self.Pairs)) + " sources")
+
+    def Sample(self, count: int, rng: np.random.Generator):
+        shape = (count, self.ImageSize, self.ImageSize, 3)
+        rgb = np.empty(shape, dtype=np.uint8)
+        normal = np.empty(shape, dtype=np.uint8)
+        sources = rng.choice(len(self.Pairs), count, p=self.Weights)
+        for i, source in enumerate(sources):
+            rgbImg, normalImg = self.Pairs[source]
+            y = rng.integers(0, rgbImg.shape[0] - self.ImageSize + 1)
+            x = rng.integers(0, rgbImg.shape[1] - self.ImageSize + 1)
+            rgbCrop = rgbImg[y:y + self.ImageSize, x:x + self.ImageSize]
+            normalCrop = normalImg[y:y + self.ImageSize, x:x + self.ImageSize]
+            if self.Augment:
+                rgbCrop, normalCrop = TransformPair(rgbCrop, normalCrop, bool(rng.integers(2)),
+                                                    int(rng.integers(4)), self.GreenUp)
+            rgb[i] = rgbCrop
+            normal[i] = normalCrop
+        return rgb, normal
+
+    def Batches(self, batchSize: int = 32, shuffle: bool = True):
+        if not self.IsLoaded:
+            self.Load()
+        return CropSequence(self, batchSize, self.ImageCount, self.Training)
+
+
+class CropSequence(Sequence):
+    def __init__(self, sampler: CropSampler, batchSize: int = 32, imageCount: int = 1000, random: bool = True):
+        super(CropSequence, self).__init__()
+        self.Sampler = sampler
+        self.BatchSize = batchSize
+        self.ImageCount = imageCount
+        self.Random = random
+        self.Epoch = 0
+
+    def __len__(self):
+        return math.ceil(self.ImageCount / self.BatchSize)
+
+    def __getitem__(self, index: int):
+        count = min(self.BatchSize, self.ImageCount - index * self.BatchSize)
+        # training crops are new every epoch, testing crops are the same every time
+        epoch = self.Epoch if self.Random else 0
+        rng = np.random.default_rng((self.Sampler.Seed, epoch, index))
+        with Trace.Span("crop batch", items=count):
+            return self.Sampler.Sample(count, rng)
+
+    def on_epoch_end(self):
+        self.Epoch += 1
@@ -1,62 +1,72 @@
 import logging
 import os.path
-import random
-import cv2
 import numpy as np
-from tqdm import tqdm
+from TileStore import TileStore
+from TileManifest import TileManifest
+from Tracing import Trace
+from MemoryBudget import Memory, TileBytes
 
 class Dataset:
-    def __init__(self, datasetDirectory: str, imageCount: int = 1000, loadOnInit: bool = False, training: bool = True):
+    def __init__(self, datasetDirectory: str, imageCount: int = 1000, loadOnInit: bool = False, training: bool = True,
+                 streaming: bool = False, imageSize: int = 64):
         self.ImageCount = imageCount
         self.Dataset = None
+        self.Streaming = streaming
+        self.Training = training
+        self.Store = None
+        self.Indices = None
         self.DatasetDir = datasetDirectory
         self.IsLoaded = False
 
         if self.DatasetDir[0] == '/':
             self.DatasetDir = self.DatasetDir[1:]
 
-        self.RGBPath = None
-        self.NormalPath = None
-
-        if training:
-            self.RGBPath = os.path.join(self.DatasetDir, "training/rgb")
-            self.NormalPath = os.path.join(self.DatasetDir, "training/normal")
-        else:
-            self.RGBPath = os.path.join(self.DatasetDir, "testing/rgb")
-            self.NormalPath = os.path.join(self.DatasetDir, "testing/normal")
+        self.StorePath = os.path.join(self.DatasetDir, "tiles_" + str(imageSize))
 
         if loadOnInit:
             self.Load()
 
     def Load(self):
+        store = TileStore(self.StorePath)
+        store.Open()
+        manifest = TileManifest(self.StorePath)
+        manifest.Open()
+        # tiles are picked by index from the manifest split, the store itself is shared
+        indices = manifest.Indices(self.Training)
+        if indices.shape[0] == 0:
+            raise ValueError("The tile store at " + self.StorePath + " has no " +
+                             ("training" if self.Training else "testing") + " tiles!")
+        # a deduplicated tile stands for every window it replaced, repeating it keeps the distribution of the windows
+        indices = np.repeat(indices, manifest.References[indices])
+
+        if self.Streaming:
+            # tiles stay in the memory-mapped shards and are read batch by batch
+            logging.info("Streaming dataset of " + str(indices.shape[0]) + " tiles from " + self.StorePath)
+            self.Store = store
+            self.Indices = indices
+            self.IsLoaded = True
+            return
+
+        self.ImageCount = Memory.DatasetCount(store.WindowSize, self.ImageCount)
         logging.info("Loading dataset of " + str(self.ImageCount) + " images")
-        files = [f for f in os.listdir(self.RGBPath) if os.path.isfile(os.path.join(self.RGBPath, f))]
-        selectedFiles = []
-
-        while len(selectedFiles) < self.ImageCount:
-            selection = random.choice(files)
-            #if selection not in selectedFiles:
-            selectedFiles.append(selection)
-        logging.debug("Files selected for loading")
-
-        self.Dataset = [[], []]
-        for i in tqdm(range(len(selectedFiles))):
-            f = selectedFiles[i]
-            # load rgb first
-            path = os.path.join(self.RGBPath, f)
-            rgbImg = cv2.imread(path)
-            # load normal next
-            path = os.path.join(self.NormalPath, f)
-            normalImg = cv2.imread(path)
-            # normalise
-            rgbImg = np.asarray(rgbImg, dtype=np.float32)
-            normalImg = np.asarray(normalImg, dtype=np.float32)
-
-            rgbImg /= 255
-            normalImg /= 255
-            # add images to array
-            self.Dataset[0].append(rgbImg)
-            self.Dataset[1].append(normalImg)
+        # duplicates are only drawn when more tiles are asked for than the windows the store stands for,
+        # sorted indices turn the shard reads into sequential access
+        selected = np.sort(np.random.choice(indices, self.ImageCount, replace=self.ImageCount > indices.shape[0]))
+        logging.debug("Tiles selected for loading")
 
+        with Trace.Span("dataset read", items=self.ImageCount) as span, \
+                Memory.Stage("dataset load", self.ImageCount * 2 * TileBytes(store.WindowSize)):
+            rgbImg, normalImg = store.Read(selected)
+            span.Add("bytesRead", rgbImg.nbytes + normalImg.nbytes)
+        # tiles stay uint8, the network scales them itself
+        self.Dataset = [rgbImg, normalImg]
         self.IsLoaded = True
         logging.info("Dataset loaded!")
+
+    def Batches(self, batchSize: int = 32, shuffle: bool = True):
+        if not self.Streaming:
+            raise ValueError("Batches are only served by streaming datasets!")
+        if not self.IsLoaded:
+            self.Load()
+        from TileSequence import TileSequence
+        return TileSequence(self.Store, self.Indices, batchSize, self.ImageCount, shuffle)
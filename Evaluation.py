@@ -0,0 +1,124 @@
+import logging
+import os.path
+import time
+import cv2
+import numpy as np
+from ImageBuilder import ImageBuilder
+from ImageProcessor import ImageProcessor
+from WindowedPredictor import WindowOffsets
+from NormalMetrics import AngularError, MeanSquaredError, SeamScore
+from Tracing import Trace
+
+
+def ParetoFront(rows: list) -> list:
+    # a configuration is kept when no cheaper one has a lower error
+    best = None
+    for row in sorted(rows, key=lambda r: (r["secondsPerMegapixel"], r["angularError"])):
+        row["pareto"] = best is None or row["angularError"] < best
+        if row["pareto"]:
+            best = row["angularError"]
+    return rows
+
+
+class Evaluation:
+    def __init__(self, workDir: str, rgbPath: str, normalPath: str, sizes: list, shifts: list, useNumpy: bool = False,
+                 count: int = 0, maxHeight: int = 1024):
+        self.WorkDir = workDir
+        self.RGBPath = rgbPath
+        self.NormalPath = normalPath
+        self.Sizes = sizes
+        self.Shifts = shifts
+        self.UseNumpy = useNumpy
+        self.Count = count
+        self.MaxHeight = maxHeight
+        self.Images = []
+
+    def LoadImages(self):
+        names = sorted(set(os.listdir(self.RGBPath)) & set(os.listdir(self.NormalPath)))
+        if self.Count > 0:
+            names = names[:self.Count]
+        for name in names:
+            rgbImg, normalImg = ImageProcessor.LoadPair(os.path.join(self.RGBPath, name),
+                                                        os.path.join(self.NormalPath, name))
+            while self.MaxHeight > 0 and rgbImg.shape[0] > self.MaxHeight:
+                dim = (rgbImg.shape[1] // 2, rgbImg.shape[0] // 2)
+                rgbImg = cv2.resize(rgbImg, dim, interpolation=cv2.INTER_AREA)
+                normalImg = cv2.resize(normalImg, dim, interpolation=cv2.INTER_AREA)
+            self.Images.append((name, rgbImg, normalImg))
+        logging.info("Evaluating on " + str(len(self.Images)) + " textures")
+
+    def LoadNetwork(self, size: int):
+        if self.UseNumpy:
+            from NumpyNetwork import NumpyNetwork
+            network = NumpyNetwork(self.WorkDir, size)
+        else:
+            from Network import NormalGeneratorNetwork
+            network = NormalGeneratorNetwork(self.WorkDir, size)
+        if not network.IsModelExists():
+            return None
+        network.LoadModel()
+        return network
+
+    def Configurations(self, size: int) -> list:
+        # tiled is a shifted pass without overlap, the full pass has no windows at all
+        configurations = [("tiled", size, "uniform")]
+        configurations += [("shifted", shift, "feathered") for shift in self.Shifts if shift < size]
+        configurations.append(("full", 0, None))
+        return configurations
+
+    def Run(self) -> list:
+        if len(self.Images) == 0:
+            self.LoadImages()
+        rows = []
+        for size in self.Sizes:
+            network = self.LoadNetwork(size)
+            if network is None:
+                logging.error("No model of {0} size exists, skipping it".format(size))
+                continue
+            builder = ImageBuilder(self.WorkDir, network, size)
+            for mode, shift, weighting in self.Configurations(size):
+                if weighting is not None:
+                    builder.Weighting = weighting
+                with Trace.Span("evaluate " + mode, items=len(self.Images)):
+                    rows.append(self.Evaluate(builder, size, mode, shift))
+                row = rows[-1]
+                logging.info("{0} {1} {2}: {3:.3f} deg, {4:.2f} s/MP".format(
+                    size, mode, shift, row["angularError"], row["secondsPerMegapixel"]))
+        return ParetoFront(rows)
+
+    def Evaluate(self, builder: ImageBuilder, size: int, mode: str, shift: int) -> dict:
+        seconds = 0.0
+        windows = 0
+        pixels = 0
+        errors = []
+        squared = []
+        seams = []
+        for _, rgbImg, normalImg in self.Images:
+            builder.InputImage = rgbImg
+            start = time.perf_counter()
+            if mode == "full":
+                predicted = builder.BuildFullImage()
+            else:
+                predicted = builder.BuildShiftedImage(shift)
+            seconds += time.perf_counter() - start
+            if mode != "full":
+                windows += WindowOffsets(rgbImg.shape[0], size, shift).shape[0] * \
+                    WindowOffsets(rgbImg.shape[1], size, shift).shape[0]
+            pixels += rgbImg.shape[0] * rgbImg.shape[1]
+
+            errors.append(AngularError(predicted, normalImg).mean())
+            squared.append(MeanSquaredError(predicted, normalImg))
+            # window borders of a full pass are checked on the tile grid, there should be nothing to find
+            seams.append(SeamScore(predicted, normalImg, shift if mode == "shifted" else size))
+
+        return {
+            "size": size,
+            "mode": mode,
+            "shift": shift,
+            "angularError": float(np.mean(errors)),
+            "mse": float(np.mean(squared)),
+            "seamScore": float(np.mean(seams)),
+            "latency": seconds / len(self.Images),
+            "windowsPerSecond": windows / seconds if seconds > 0 else 0.0,
+            "secondsPerMegapixel": seconds / (pixels / 1e6)
+        }
@@ -1,27 +1,23 @@
 import logging
+import os
 import os.path
 import random
+from typing import TYPE_CHECKING
 
 import cv2
 import numpy as np
-from Network import NormalGeneratorNetwork
 from ImageProcessor import SplitImage
-from tqdm import tqdm
+from WindowedPredictor import WindowedPredictor, QuantizeImage, PredictUnique
+from Tracing import Trace
+from TileManifest import TileManifest
+from ResultCache import ResultCache
+from MemoryBudget import Memory, ActivationBytes, TileBytes
 
-def PartCount(imageSize: int, windowSize: int, shiftSize: int) -> int:
-    count = 0
-    xPos = 0
-    while xPos + windowSize <= imageSize:
-        yPos = 0
-        while yPos + windowSize <= imageSize:
-            count += 1
-            yPos += shiftSize
-        xPos += shiftSize
-
-    return count
+if TYPE_CHECKING:
+    from Network import NormalGeneratorNetwork
 
 class ImageBuilder:
-    def __init__(self, workDir: str, network: NormalGeneratorNetwork, imageSize: int):
+    def __init__(self, workDir: str, network: "NormalGeneratorNetwork", imageSize: int):
         self.Network = network
         self.ImageSize = imageSize
         self.RGBPath = "rgb"
@@ -32,15 +28,25 @@ class ImageBuilder:
         if self.WorkDir[0] == '/':
             self.WorkDir = self.WorkDir[1:]
         self.WindowShiftSize = 4
+        self.BatchSize = 256
+        self.StripHeight = 0
+        self.StreamStripHeight = 256
+        self.DemoImageHeight = 1024
+        self.Weighting = "feathered"
+        self.Cache = None  # type: ResultCache
+        self.Digest = None
 
     def GenerateImage(self):
         logging.info("Generating full normal map!")
         self.SelectRandomImage()
+        self.BatchSize = Memory.InferenceBatchSize(self.ImageSize, self.BatchSize)
+        height, width = self.InputImage.shape[0], self.InputImage.shape[1]
+        batchBytes = self.BatchSize * (ActivationBytes(self.ImageSize) + TileBytes(self.ImageSize))
         # full tiling
-        parts = SplitImage(self.InputImage, self.ImageSize, self.ImageSize).astype('float64')
-        parts /= 255
-        predicted = self.PredictParts(parts)
-        rebuilt = self.BuildTiledImage(predicted)
+        with Memory.Stage("tiled generation", 2 * height * width * 3 + height * width * 3 * 4 + batchBytes):
+            parts = SplitImage(self.InputImage, self.ImageSize, self.ImageSize)
+            predicted = self.PredictParts(parts)
+            rebuilt = self.BuildTiledImage(predicted)
         self.SaveImage(rebuilt, "built_tiled_" + str(self.ImageSize) + ".png")
         # windowed tiling
         shifts = [8, 16, 32, 64]
@@ -48,68 +54,57 @@ class ImageBuilder:
             if s >= self.ImageSize:
                 continue
             logging.debug("Building shifted image with shift {0}".format(s))
-            shifted = self.BuildShiftedImage(s)
+            with Memory.Stage("shifted generation " + str(s), Memory.CanvasBytes(height, width) + batchBytes):
+                shifted = self.BuildShiftedImage(s)
             self.SaveImage(shifted, "built_shifted_" + str(self.ImageSize) + "_" + str(s) + ".png")
+        # whole image in a single pass
+        if Memory.Limit > 0:
+            self.StripHeight = Memory.StripHeight(width, self.StripHeight if self.StripHeight > 0 else height)
+        stripHeight = self.StripHeight if 0 < self.StripHeight < height else height
+        with Memory.Stage("full generation", ActivationBytes(1) * width * stripHeight + height * width * 3 * 5):
+            fullImage = self.BuildFullImage()
+        self.SaveImage(fullImage, "built_full_" + str(self.ImageSize) + ".png")
 
         logging.info("Normal map generation is finished!")
 
     def SelectRandomImage(self):
-        rgb_files = [f for f in os.listdir(self.RGBPath) if os.path.isfile(os.path.join(self.RGBPath, f))]
+        manifest = TileManifest(os.path.join(self.WorkDir, "tiles_" + str(self.ImageSize)))
+        if manifest.IsManifestValid():
+            manifest.Open()
+            rgb_files = manifest.Sources
+        else:
+            rgb_files = [f for f in os.listdir(self.RGBPath) if os.path.isfile(os.path.join(self.RGBPath, f))]
 
         selectedImage = random.choice(rgb_files)
         self.InputImage = cv2.imread(os.path.join(self.RGBPath, selectedImage))
         self.ExpectedImage = cv2.imread(os.path.join(self.NormalPath, selectedImage))
 
-        while self.InputImage.shape[0] > 1024:
-            dim = (int(self.InputImage.shape[0] / 2), int(self.InputImage.shape[1] / 2))
+        # the demo also predicts every shifted window, so it keeps working on a reduced image
+        while self.InputImage.shape[0] > self.DemoImageHeight:
+            dim = (self.InputImage.shape[1] // 2, self.InputImage.shape[0] // 2)
             self.InputImage = cv2.resize(self.InputImage, dim, interpolation=cv2.INTER_AREA)
             self.ExpectedImage = cv2.resize(self.ExpectedImage, dim, interpolation=cv2.INTER_AREA)
 
     def BuildTiledImage(self, parts: np.ndarray):
-        newImage = np.zeros((self.InputImage.shape[0], self.InputImage.shape[1], 3))
-        shift = self.ImageSize
-        steps = int(((self.InputImage.shape[0] - self.ImageSize) / shift) + 1)
-        count = 0
-
-        for x in range(steps):
-            for y in range(steps):
-                xStart = x * shift
-                xEnd = (x + 1) * shift
-                yStart = y * shift
-                yEnd = (y + 1) * shift
-                selectedPart = y * steps + x
-                selectedPart = parts[count, :, :, :].reshape((self.ImageSize, self.ImageSize, 3))
-                count += 1
-                newImage[xStart:xEnd, yStart:yEnd, :] = selectedPart
-
-        newImage = np.round(newImage * 255, decimals=0).astype('uint8')
-        return newImage
+        with Trace.Span("stitching", items=parts.shape[0]):
+            return self.StitchTiles(parts)
+
+    def StitchTiles(self, parts: np.ndarray) -> np.ndarray:
+        newImage = np.zeros((self.InputImage.shape[0], self.InputImage.shape[1], 3), dtype=np.float32)
+        rows = self.InputImage.shape[0] // self.ImageSize
+        cols = self.InputImage.shape[1] // self.ImageSize
+        # the parts come in row-major window order, so a transpose puts them back in place
+        grid = parts[:rows * cols].reshape((rows, cols, self.ImageSize, self.ImageSize, 3))
+        newImage[:rows * self.ImageSize, :cols * self.ImageSize, :] = \
+            grid.transpose((0, 2, 1, 3, 4)).reshape((rows * self.ImageSize, cols * self.ImageSize, 3))
+
+        return QuantizeImage(newImage)
 
     def BuildShiftedImage(self, shift: int) -> np.ndarray:
-        newImage = np.zeros((self.InputImage.shape[0], self.InputImage.shape[1], 3))
-        step_count = int((self.InputImage.shape[0] - self.ImageSize) / shift) + 1
-        for cols in tqdm(range(step_count)):
-            parts = []
-            for rows in range(step_count):
-                part = self.InputImage[
-                       cols * shift: cols * shift + self.ImageSize,
-                       rows * shift : rows * shift + self.ImageSize,
-                       :]
-                parts.append(part)
-            parts = np.asarray(parts).astype('float64')
-            parts /= 255
-            predicted = self.PredictParts(parts)
-            parts = 0
-            for rows in range(step_count):
-                current_part = predicted[parts, :, :, :].reshape((self.ImageSize, self.ImageSize, 3))
-                newImage[
-                    cols * shift : cols * shift + self.ImageSize,
-                    rows * shift : rows * shift + self.ImageSize,
-                    :
-                ] = current_part
-                parts += 1
-        newImage = np.round(newImage * 255, decimals=0).astype('uint8')
-        return newImage
+        predictor = WindowedPredictor(self.PredictBatch, self.ImageSize, self.BatchSize, self.Weighting)
+        newImage = predictor.Predict(self.InputImage, shift)
+        self.ReportDeduplication(predictor.WindowCount, predictor.PredictedCount)
+        return QuantizeImage(newImage)
 
     def SaveImage(self, image: np.ndarray, name: str):
         path = os.path.join(self.WorkDir, "result_" + str(self.ImageSize))
@@ -117,19 +112,74 @@ class ImageBuilder:
         cv2.imwrite(os.path.join(path, "expected_full_" + str(self.ImageSize) + ".png"), self.ExpectedImage)
         cv2.imwrite(os.path.join(path, "input_rgb_" + str(self.ImageSize) + ".png"), self.InputImage)
 
-    def BuildSinglePicture(self, filePath: str):
-        self.InputImage = cv2.imread(filePath)
-        while self.InputImage.shape[0] > 1024:
-            dim = (int(self.InputImage.shape[0] / 2), int(self.InputImage.shape[1] / 2))
-            self.InputImage = cv2.resize(self.InputImage, dim, interpolation=cv2.INTER_AREA)
-
-        parts = SplitImage(self.InputImage, self.ImageSize, self.ImageSize).astype('float64')
-        parts /= 255
-
-        predicted = self.PredictParts(parts)
-        rebuilt = self.BuildTiledImage(predicted)
-
-        cv2.imwrite("generated_normal.png", rebuilt)
+    @staticmethod
+    def ReadInputImage(filePath: str) -> np.ndarray:
+        # .npy inputs are memory-mapped, so only the rows of the current strip are paged in
+        if filePath.endswith(".npy"):
+            image = np.load(filePath, mmap_mode='r')
+        else:
+            image = cv2.imread(filePath)
+        if image is None or len(image.shape) != 3 or image.shape[2] != 3:
+            raise ValueError(filePath + " cannot be opened!")
+        return image
+
+    def BuildSinglePicture(self, filePath: str, outputPath: str = "generated_normal.png"):
+        self.InputImage = self.ReadInputImage(filePath)
+        key = self.CacheKey()
+        if key is not None and self.Cache.Get(key, outputPath):
+            logging.debug("Cached normal map used for " + filePath)
+            return
+        self.StreamImage(outputPath)
+        if key is not None:
+            self.Cache.Put(key, outputPath)
+
+    def CacheKey(self, shift: int = 0):
+        # the output depends on the input pixels, the weights and the generation settings
+        if self.Cache is None:
+            return None
+        if self.Digest is None:
+            self.Digest = self.Network.ModelDigest()
+        parameters = {"size": self.ImageSize, "shift": shift, "weighting": self.Weighting if shift > 0 else None}
+        with Trace.Span("cache key", items=1):
+            return ResultCache.Key(self.InputImage, self.Digest, parameters)
+
+    def StreamImage(self, outputPath: str):
+        # the output rows go to a memory-mapped array strip by strip, the image is never held as floats
+        stripHeight = self.StripHeight if self.StripHeight > 0 else self.StreamStripHeight
+        stripHeight = Memory.StripHeight(self.InputImage.shape[1], stripHeight)
+        shape = (self.InputImage.shape[0], self.InputImage.shape[1], 3)
+        mappedPath = outputPath if outputPath.endswith(".npy") else outputPath + ".rows.npy"
+        output = np.lib.format.open_memmap(mappedPath, mode='w+', dtype=np.uint8, shape=shape)
+        try:
+            estimate = ActivationBytes(1) * shape[1] * (stripHeight + 2 * self.Network.StripHalo)
+            with Trace.Span("predict full image", items=1), Memory.Stage("streamed generation", estimate):
+                for start, end, strip in self.Network.PredictStrips(self.InputImage, stripHeight):
+                    output[start:end] = QuantizeImage(strip)
+            output.flush()
+            if mappedPath != outputPath:
+                with Trace.Span("encode", items=1):
+                    if not cv2.imwrite(outputPath, output):
+                        raise ValueError(outputPath + " cannot be written!")
+        finally:
+            del output
+            if mappedPath != outputPath:
+                os.unlink(mappedPath)
+
+    def BuildFullImage(self) -> np.ndarray:
+        with Trace.Span("predict full image", items=1):
+            newImage = self.Network.PredictFullImage(self.InputImage, self.StripHeight)
+        return QuantizeImage(newImage)
 
     def PredictParts(self, parts: np.ndarray):
-        return self.Network.Predict(parts, False)
+        predicted, predictedCount = PredictUnique(self.PredictBatch, parts)
+        self.ReportDeduplication(parts.shape[0], predictedCount)
+        return predicted
+
+    def PredictBatch(self, parts: np.ndarray):
+        return self.Network.Predict(parts, False, self.BatchSize)
+
+    @staticmethod
+    def ReportDeduplication(windowCount: int, predictedCount: int):
+        if windowCount > 0:
+            logging.debug("{0} of {1} windows predicted, {2:.1%} of the inference saved by deduplication".format(
+                predictedCount, windowCount, 1 - predictedCount / windowCount))
@@ -1,38 +1,117 @@
 import logging
-import math
+import multiprocessing
 import os
 import cv2
 import shutil
+import time
 import numpy as np
+from TileStore import TileStore
+from TileManifest import TileManifest
+from TileCache import TileCache
+from Tracing import Trace
+from WindowedPredictor import HashWindows
+from MemoryBudget import Memory
 
 
-def SplitImage(image: np.ndarray, shift: int, windowSize: int, maxCount: int = 0, skip: int = 0) -> np.ndarray:
-    if image.shape[0] != image.shape[1]:
-        raise ValueError("The input image must have the same width and height!")
+def WindowGrid(image: np.ndarray, shift: int, windowSize: int) -> np.ndarray:
     if len(image.shape) != 3:
         raise ValueError("The input image must have 3 dimensions. Got " + str(len(image.shape)) + " instead.")
-    if windowSize > image.shape[0]:
+    if windowSize > image.shape[0] or windowSize > image.shape[1]:
         raise ValueError("The input image is smaller then the used window.")
 
-    parts = []
-    xPos = 0
-    while xPos + windowSize <= image.shape[0]:
-        yPos = 0
-        while yPos + windowSize <= image.shape[1]:
-            if skip == 0:
-                part = image[xPos:xPos + windowSize, yPos:yPos + windowSize, :]
-                parts.append(part)
-            else:
-                skip -= 1
-            yPos += shift
-            if 0 < maxCount <= len(parts):
+    rows = (image.shape[0] - windowSize) // shift + 1
+    cols = (image.shape[1] - windowSize) // shift + 1
+    strides = image.strides
+    # (rows, cols, windowSize, windowSize, channels) view into the image, nothing is copied
+    return np.lib.stride_tricks.as_strided(
+        image,
+        shape=(rows, cols, windowSize, windowSize, image.shape[2]),
+        strides=(strides[0] * shift, strides[1] * shift, strides[0], strides[1], strides[2]),
+        writeable=False)
+
+
+def SplitImage(image: np.ndarray, shift: int, windowSize: int, maxCount: int = 0, skip: int = 0,
+               materialize: bool = True) -> np.ndarray:
+    grid = WindowGrid(image, shift, windowSize)
+    if not materialize:
+        if maxCount != 0 or skip != 0:
+            raise ValueError("maxCount and skip can only be used on materialized windows.")
+        return grid
+
+    total = grid.shape[0] * grid.shape[1]
+    end = total if maxCount <= 0 else min(total, skip + maxCount)
+    if skip == 0 and end == total:
+        return np.ascontiguousarray(grid).reshape((total, windowSize, windowSize, image.shape[2]))
+
+    rows, cols = np.divmod(np.arange(skip, max(skip, end)), grid.shape[1])
+    return grid[rows, cols]
+
+
+SharedTileCounts = None
+
+
+def InitTilingWorker(counters: list):
+    global SharedTileCounts
+    SharedTileCounts = counters
+
+
+def ReserveTiles(count: int, maxCount: int, level: int) -> int:
+    if maxCount <= 0:
+        return count
+    counter = SharedTileCounts[level]
+    with counter.get_lock():
+        count = max(0, min(count, maxCount - counter.value))
+        counter.value += count
+    return count
+
+
+def TilePair(task: tuple) -> tuple:
+    # the pair is decoded once and tiled for every pyramid level that needs it.
+    # a pool worker has its own tracer, so the decode time goes back with the results and the parent records it
+    rgbPath, normalPath, jobs = task
+    start = time.perf_counter()
+    rgbImg, normalImg = ImageProcessor.LoadPair(rgbPath, normalPath)
+    decode = (start, time.perf_counter(), os.getpid())
+
+    results = []
+    for level, storePath, windowSize, windowStep, maxCount, key in jobs:
+        ImageProcessor.CheckTileable(rgbImg, windowSize, rgbPath)
+        rgbGrid = SplitImage(rgbImg, windowStep, windowSize, materialize=False)
+        normalGrid = SplitImage(normalImg, windowStep, windowSize, materialize=False)
+        store = TileStore(storePath, windowSize, shardPrefix=key + "_")
+        columns = rgbGrid.shape[1]
+        # identical windows are stored once, the first one stands for the others with its reference count
+        stored = {}
+        windows = []
+        references = []
+        complete = True
+        for row in range(rgbGrid.shape[0]):
+            unique = {}  # digest -> column, references of the windows first seen in this row
+            for col, digest in enumerate(HashWindows(rgbGrid[row], normalGrid[row])):
+                if digest in stored:
+                    references[stored[digest]] += 1
+                elif digest in unique:
+                    unique[digest][1] += 1
+                else:
+                    unique[digest] = [col, 1]
+            # only the windows that will be stored count against MaxCount
+            count = ReserveTiles(len(unique), maxCount, level)
+            kept = list(unique.items())[:count]
+            for digest, (col, refs) in kept:
+                stored[digest] = len(windows)
+                windows.append(row * columns + col)
+                references.append(refs)
+            if count > 0:
+                cols = [col for _, (col, _) in kept]
+                store.Add(rgbGrid[row, cols], normalGrid[row, cols])
+            if count < len(unique):
+                complete = False
                 break
-        xPos += shift
-        if 0 < maxCount <= len(parts):
-            break
-
-    parts = np.asarray(parts)
-    return parts
+        store.Flush()
+        index = np.stack([np.asarray(windows, dtype=np.int64), np.asarray(references, dtype=np.int64)], axis=1)
+        np.save(os.path.join(storePath, TileCache.IndexFileName(key)), index)
+        results.append((store.Shards, store.Count, columns, rgbGrid.shape[0] * columns, complete))
+    return results, decode
 
 
 class ImageProcessor:
@@ -49,8 +128,6 @@ class ImageProcessor:
         if self.DatasetDirectory[0] == '/':
             self.DatasetDirectory = self.DatasetDirectory[1:]
 
-        self.TrainingPath = os.path.join(self.DatasetDirectory, "training")
-        self.TestingPath = os.path.join(self.DatasetDirectory, "testing")
 
         if not self.CreateMissingFolder(self.RGBPath):
             return
@@ -58,10 +135,6 @@ class ImageProcessor:
             return
         if not self.CreateMissingFolder(self.DatasetDirectory):
             return
-        if not self.CreateMissingFolder(self.TrainingPath):
-            return
-        if not self.CreateMissingFolder(self.TestingPath):
-            return
 
     @staticmethod
     def IsDirectoryValid(path: str) -> bool:
@@ -79,126 +152,193 @@ class ImageProcessor:
                 return False
         return True
 
-    def ProcessImages(self, windowSize: int = 32, windowStep: int = 2, eraseExisting: bool = True):
-        if not self.CreateMissingFolder(os.path.join(self.TrainingPath, "rgb")): return
-        if not self.CreateMissingFolder(os.path.join(self.TrainingPath, "normal")): return
-
-        if not self.CreateMissingFolder(os.path.join(self.TestingPath, "rgb")): return
-        if not self.CreateMissingFolder(os.path.join(self.TestingPath, "normal")): return
-
-        if not self.CreateMissingFolder(os.path.join(self.DatasetDirectory, "result_" + str(windowSize))): return
-
-        if eraseExisting:
-            self.ClearAllData()
-
-        rgb_files = [f for f in os.listdir(self.RGBPath) if os.path.isfile(os.path.join(self.RGBPath, f))]
-        normal_files = [f for f in os.listdir(self.NormalPath) if os.path.isfile(os.path.join(self.NormalPath, f))]
-
-        # check for same
-        for rgb in rgb_files:
-            for n in normal_files:
-                if rgb == n:
-                    break
-            else:
-                logging.error("No match for " + str(rgb) + " found! removing it from the list!")
-                rgb_files.remove(rgb)
-        for n in normal_files:
-            for rgb in rgb_files:
-                if rgb == n:
-                    break
+    def TileDirectory(self, windowSize: int) -> str:
+        return os.path.join(self.DatasetDirectory, "tiles_" + str(windowSize))
+
+    def ProcessImages(self, windowSize: int = 32, windowStep: int = 2, eraseExisting: bool = False, workers: int = 1):
+        self.ProcessPyramid([(windowSize, windowStep)], eraseExisting, workers)
+
+    def ProcessPyramid(self, sizes: list, eraseExisting: bool = False, workers: int = 1):
+        pairs = self.ListSourcePairs()
+        digests = {}
+        caches = []
+        keys = []
+        missing = []
+        cached = []
+        for windowSize, windowStep in sizes:
+            if not self.CreateMissingFolder(os.path.join(self.DatasetDirectory, "result_" + str(windowSize))): return
+            tilePath = self.TileDirectory(windowSize)
+            if not self.CreateMissingFolder(tilePath): return
+            if eraseExisting:
+                self.ClearFolder(tilePath)
+
+            cache = TileCache(tilePath, windowSize, windowStep)
+            if cache.IsCacheValid() and not cache.Open():
+                logging.info("Tiles of size " + str(windowSize) + " were made with another step, rebuilding them")
+                self.ClearFolder(tilePath)
+            levelKeys = [cache.SourceKey(f, os.path.join(self.RGBPath, f), os.path.join(self.NormalPath, f), digests)
+                         for f in pairs]
+
+            # only new or changed sources are tiled, their tiles count against MaxCount after the cached ones
+            levelCached = 0
+            levelMissing = {}
+            levelPartial = {}
+            for f, key in zip(pairs, levelKeys):
+                entry = cache.GetEntry(key)
+                if entry is None:
+                    if key not in levelMissing.values():
+                        levelMissing[f] = key
+                elif entry["complete"]:
+                    levelCached += entry["count"]
+                else:
+                    levelPartial[f] = key
+            # sources cut short by MaxCount are only tiled again when the cache holds fewer tiles than asked for
+            partialCount = sum(cache.Entries[key]["count"] for key in levelPartial.values())
+            if self.MaxCount > 0 and levelCached + partialCount >= self.MaxCount:
+                levelCached += partialCount
+                levelMissing = {}
             else:
-                logging.error("No match for " + str(n) + " found! removing it from the list!")
-                normal_files.remove(n)
-        logging.info("Beginning of image processing")
-        logging.debug("Tiling RGB images...")
-        count = 1
-        for f in rgb_files:
-            self.CreateTiledImage(windowSize, windowStep, os.path.join(self.RGBPath, f), False, count)
-            count += 1
-        logging.debug("Tiling normal images...")
-        count = 1
-        for f in normal_files:
-            self.CreateTiledImage(windowSize, windowStep, os.path.join(self.NormalPath, f), True, count)
-            count += 1
-        logging.info("Image processing done!")
-
-    def CreateTiledImage(self, windowSize: int, windowStep: int, fileName: str, isNormal: bool, imgNumber: int):
-        img = cv2.imread(fileName)
+                for f, key in levelPartial.items():
+                    if key not in levelMissing.values():
+                        levelMissing[f] = key
+            caches.append(cache)
+            keys.append(levelKeys)
+            missing.append(levelMissing)
+            cached.append(levelCached)
+            logging.debug("Size " + str(windowSize) + ": " + str(len(pairs) - len(levelMissing)) +
+                          " sources are cached, " + str(len(levelMissing)) + " are tiled")
+
+        tasks = []
+        for f in pairs:
+            jobs = [(level, caches[level].Path, caches[level].WindowSize, caches[level].WindowStep, self.MaxCount,
+                     missing[level][f]) for level in range(len(sizes)) if f in missing[level]]
+            if len(jobs) > 0:
+                tasks.append((os.path.join(self.RGBPath, f), os.path.join(self.NormalPath, f), jobs))
+        counters = [multiprocessing.Value('q', min(c, self.MaxCount) if self.MaxCount > 0 else 0) for c in cached]
 
-        if isNormal:
-            savePath = os.path.join(self.TrainingPath, "normal")
+        logging.info("Beginning of image processing")
+        with Trace.Span("tiling") as span, Memory.Stage("tiling"):
+            for task, (results, decode) in zip(tasks, self.TileSources(tasks, counters, workers)):
+                worker = None if decode[2] == os.getpid() else decode[2]
+                Trace.Record("decode", decode[0], decode[1], {"items": 2}, worker)
+                for job, (shards, count, columns, total, complete) in zip(task[2], results):
+                    level, key = job[0], job[5]
+                    caches[level].SetEntry(key, shards, count, columns, total, complete)
+                    span.Add("items", count)
+                    span.Add("bytesWritten", count * job[2] * job[2] * 3 * 2)
+                    if complete and total > 0:
+                        logging.debug("{0} at size {1}: {2} of {3} windows are unique ({4:.1%} stored)".format(
+                            os.path.basename(task[0]), job[2], count, total, count / total))
+
+            for level in range(len(sizes)):
+                self.ReportDeduplication(keys[level], caches[level])
+                self.WriteIndex(pairs, keys[level], caches[level])
+                caches[level].CollectGarbage(pairs, keys[level])
+                caches[level].Save()
+
+    def TileSources(self, tasks: list, counters: list, workers: int):
+        if workers > 1 and len(tasks) > 1:
+            logging.debug("Tiling " + str(len(tasks)) + " image pairs with " + str(workers) + " workers")
+            with multiprocessing.Pool(workers, initializer=InitTilingWorker, initargs=(counters,)) as pool:
+                # every pair has its own shard prefix, so the tile names do not depend on the scheduling
+                for result in pool.imap(TilePair, tasks):
+                    yield result
         else:
-            savePath = os.path.join(self.TrainingPath, "rgb")
+            InitTilingWorker(counters)
+            for task in tasks:
+                yield TilePair(task)
+
+    def WriteIndex(self, pairs: list, keys: list, cache: TileCache):
+        store = TileStore(cache.Path, cache.WindowSize)
+        manifest = TileManifest(cache.Path)
+        previous = TileManifest(cache.Path)
+        if previous.IsManifestValid():
+            previous.Open()
+        for f, key in zip(pairs, keys):
+            entry = cache.Entries.get(key)
+            if entry is None:
+                continue
+            count = entry["count"]
+            if self.MaxCount > 0:
+                count = max(0, min(count, self.MaxCount - store.Count))
+            # a shard may be referenced only partially when MaxCount cuts into a cached source
+            remaining = count
+            for name, size in entry["shards"]:
+                if remaining <= 0:
+                    break
+                store.Extend([[name, min(size, remaining)]])
+                remaining -= size
+            windows, references = cache.ReadIndex(key)
+            manifest.AddTiles(f, windows[:count], references[:count], entry["columns"], cache.WindowStep, key)
+        manifest.CarrySplit(previous)
+        store.WriteHeader()
+        manifest.Save()
+        logging.info("Image processing done! " + str(store.Count) + " tiles of size " + str(cache.WindowSize) +
+                     " indexed")
 
-        if img is None:
-            raise ValueError(fileName + " cannot be opened!")
+    @staticmethod
+    def ReportDeduplication(keys: list, cache: TileCache):
+        entries = [cache.Entries[key] for key in set(keys) if key in cache.Entries and cache.Entries[key]["complete"]]
+        windows = sum(e["windows"] for e in entries)
+        stored = sum(e["count"] for e in entries)
+        if windows > 0:
+            logging.info("Size {0}: {1} of {2} windows stored after deduplication, {3:.1%} of the tile data saved".format(
+                cache.WindowSize, stored, windows, 1 - stored / windows))
+
+    def ListSourcePairs(self) -> list:
+        # scandir reports the entry type without an extra stat call per file
+        with os.scandir(self.RGBPath) as entries:
+            rgbFiles = set(e.name for e in entries if e.is_file())
+        with os.scandir(self.NormalPath) as entries:
+            normalFiles = set(e.name for e in entries if e.is_file())
+
+        for f in sorted(rgbFiles ^ normalFiles):
+            logging.error("No match for " + str(f) + " found! removing it from the list!")
+        return sorted(rgbFiles & normalFiles)
+
+    @staticmethod
+    def CheckTileable(img: np.ndarray, windowSize: int, fileName: str):
         if img.shape[0] % windowSize != 0 or img.shape[1] % windowSize != 0:
             raise ValueError(fileName + " cannot be tiled with " + str(windowSize) + "!")
 
-        parts = SplitImage(img, windowStep, windowSize)
-        for i in range(parts.shape[0]):
-            existingImageCount = len(
-                [name for name in os.listdir(savePath,) if os.path.isfile(os.path.join(savePath, name))]
-            )
-            if existingImageCount >= self.MaxCount > 0:
-                break
-            save = parts[i, :, :, :].reshape((windowSize, windowSize, 3))
-            path = str(imgNumber).zfill(2) + "_" + str(i).zfill(5) + ".png"
-            path = os.path.join(savePath, path)
-            cv2.imwrite(path, save)
-
-    def CreateTestingSet(self, percent: float = 0.2):
-        rgbTrainingPath = os.path.join(self.TrainingPath, "rgb")
-        rgbTestingPath = os.path.join(self.TestingPath, "rgb")
-
-        normalTrainingPath = os.path.join(self.TrainingPath, "normal")
-        normalTestingPath = os.path.join(self.TestingPath, "normal")
-
-        rgbTiles = [f for f in os.listdir(rgbTrainingPath) if os.path.isfile(os.path.join(rgbTrainingPath, f))]
-        normalTiles = [f for f in os.listdir(normalTrainingPath) if os.path.isfile(os.path.join(normalTrainingPath, f))]
-
-        if len(rgbTiles) != len(normalTiles):
-            raise ValueError("RGB and normal tile numbers do not match! " +
-                             str(len(rgbTiles)) + " vs " + str(len(normalTiles)))
-        numberOfCopies = len(rgbTiles) * percent
-        numberOfCopies = math.floor(numberOfCopies)
-
-        if numberOfCopies == 0:
-            return
-
-        count = 0
-        for f in rgbTiles:
-            os.replace(os.path.join(rgbTrainingPath, f), os.path.join(rgbTestingPath, f))
-            count += 1
-            if count >= numberOfCopies:
-                break
+    @staticmethod
+    def LoadImage(fileName: str, windowSize: int = 0) -> np.ndarray:
+        img = cv2.imread(fileName)
+        if img is None:
+            raise ValueError(fileName + " cannot be opened!")
+        if windowSize > 0:
+            ImageProcessor.CheckTileable(img, windowSize, fileName)
+        return img
 
-        count = 0
-        for f in normalTiles:
-            os.replace(os.path.join(normalTrainingPath, f), os.path.join(normalTestingPath, f))
-            count += 1
-            if count >= numberOfCopies:
-                break
+    @staticmethod
+    def LoadPair(rgbPath: str, normalPath: str, windowSize: int = 0):
+        rgbImg = ImageProcessor.LoadImage(rgbPath, windowSize)
+        normalImg = ImageProcessor.LoadImage(normalPath, windowSize)
+        if rgbImg.shape != normalImg.shape:
+            raise ValueError("The RGB and normal image of " + rgbPath + " have different sizes!")
+        return rgbImg, normalImg
+
+    def TileDirectories(self) -> list:
+        with os.scandir(self.DatasetDirectory) as entries:
+            return sorted(e.path for e in entries if e.is_dir() and e.name.startswith("tiles_"))
+
+    def CreateTestingSet(self, percent: float = 0.2, windowSize: int = 0):
+        # the split is only a flag in the manifest, the tiles stay where they are
+        paths = [self.TileDirectory(windowSize)] if windowSize > 0 else self.TileDirectories()
+        for path in paths:
+            manifest = TileManifest(path)
+            if not manifest.IsManifestValid():
+                continue
+            manifest.Open()
+            with Trace.Span("testing split", items=manifest.Count):
+                count = manifest.CreateTestingSet(percent)
+                manifest.Save()
+            logging.debug(str(count) + " tiles of " + path + " selected for testing")
 
     def ClearAllData(self):
         logging.debug("Clearing existing data")
-        testingDir = os.path.join(self.DatasetDirectory, "testing")
-        trainingDir = os.path.join(self.DatasetDirectory, "training")
-
-        if self.IsDirectoryValid(testingDir):
-            rgbDir = os.path.join(testingDir, "rgb")
-            normalDir = os.path.join(testingDir, "normal")
-            if self.IsDirectoryValid(rgbDir):
-                self.ClearFolder(rgbDir)
-            if self.IsDirectoryValid(normalDir):
-                self.ClearFolder(normalDir)
-        if self.IsDirectoryValid(trainingDir):
-            rgbDir = os.path.join(trainingDir, "rgb")
-            normalDir = os.path.join(trainingDir, "normal")
-            if self.IsDirectoryValid(rgbDir):
-                self.ClearFolder(rgbDir)
-            if self.IsDirectoryValid(normalDir):
-                self.ClearFolder(normalDir)
+        for path in self.TileDirectories():
+            self.ClearFolder(path)
 
     @staticmethod
     def ClearFolder(path: str):
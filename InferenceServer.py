@@ -0,0 +1,176 @@
+import json
+import logging
+import queue
+import threading
+import time
+from concurrent.futures import Future
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+import cv2
+import numpy as np
+from WindowedPredictor import WindowedPredictor, QuantizeImage
+
+
+class MicroBatcher:
+    def __init__(self, network, maxBatchSize: int = 256, maxDelay: float = 0.005):
+        self.Network = network
+        self.MaxBatchSize = maxBatchSize
+        self.MaxDelay = maxDelay
+        self.Queue = queue.Queue()
+        self.Lock = threading.Lock()
+        self.QueuedWindows = 0
+        self.BatchCount = 0
+        self.WindowCount = 0
+        self.LargestBatch = 0
+        self.BatchSizes = {}
+        self.Thread = threading.Thread(target=self.Run, daemon=True)
+        self.Thread.start()
+
+    def Predict(self, windows: np.ndarray) -> np.ndarray:
+        result = Future()
+        with self.Lock:
+            self.QueuedWindows += windows.shape[0]
+        # the caller may reuse its buffer, so the windows are copied before queueing
+        self.Queue.put((np.array(windows), result))
+        return result.result()
+
+    def Run(self):
+        pending = None
+        while True:
+            requests = [pending if pending is not None else self.Queue.get()]
+            pending = None
+            count = requests[0][0].shape[0]
+            deadline = time.perf_counter() + self.MaxDelay
+            while count < self.MaxBatchSize:
+                timeout = deadline - time.perf_counter()
+                if timeout <= 0:
+                    break
+                try:
+                    request = self.Queue.get(timeout=timeout)
+                except queue.Empty:
+                    break
+                if count + request[0].shape[0] > self.MaxBatchSize:
+                    pending = request
+                    break
+                requests.append(request)
+                count += request[0].shape[0]
+            self.RunBatch(requests, count)
+
+    def RunBatch(self, requests: list, count: int):
+        with self.Lock:
+            self.QueuedWindows -= count
+            self.BatchCount += 1
+            self.WindowCount += count
+            self.LargestBatch = max(self.LargestBatch, count)
+            self.BatchSizes[count] = self.BatchSizes.get(count, 0) + 1
+        try:
+            predicted = self.Network.Predict(np.concatenate([r[0] for r in requests]), False, count)
+        except Exception as e:
+            for _, result in requests:
+                result.set_exception(e)
+            return
+        start = 0
+        for windows, result in requests:
+            result.set_result(predicted[start:start + windows.shape[0]])
+            start += windows.shape[0]
+
+    def Metrics(self) -> dict:
+        with self.Lock:
+            return {
+                "queueDepth": self.QueuedWindows,
+                "batches": self.BatchCount,
+                "windows": self.WindowCount,
+                "meanBatchSize": self.WindowCount / self.BatchCount if self.BatchCount > 0 else 0.0,
+                "largestBatch": self.LargestBatch,
+                "batchSizes": {str(k): v for k, v in sorted(self.BatchSizes.items())}
+            }
+
+
+class InferenceServer:
+    def __init__(self, workDir: str, sizes: list, maxBatchSize: int = 256, maxDelay: float = 0.005,
+                 weighting: str = "feathered"):
+        self.MaxBatchSize = maxBatchSize
+        self.Weighting = weighting
+        self.Batchers = {}
+        self.Lock = threading.Lock()
+        self.RequestCount = 0
+        from Network import NormalGeneratorNetwork
+        for size in sizes:
+            network = NormalGeneratorNetwork(workDir, size)
+            if not network.IsModelExists():
+                raise ValueError("No model of {0} size exists!".format(size))
+            network.LoadModel()
+            self.Batchers[size] = MicroBatcher(network, maxBatchSize, maxDelay)
+            logging.info("Model of size {0} is loaded".format(size))
+
+    def Generate(self, image: np.ndarray, size: int, shift: int) -> np.ndarray:
+        if size not in self.Batchers:
+            raise ValueError("No model of {0} size is loaded!".format(size))
+        # a larger shift would leave pixels between the windows uncovered
+        if shift <= 0 or shift > size:
+            raise ValueError("The shift has to be between 1 and {0}!".format(size))
+        predictor = WindowedPredictor(self.Batchers[size].Predict, size, self.MaxBatchSize, self.Weighting)
+        result = predictor.Predict(image, shift)
+        with self.Lock:
+            self.RequestCount += 1
+        return QuantizeImage(result)
+
+    def Metrics(self) -> dict:
+        return {
+            "requests": self.RequestCount,
+            "models": {str(size): batcher.Metrics() for size, batcher in self.Batchers.items()}
+        }
+
+    def Serve(self, host: str = "127.0.0.1", port: int = 8765):
+        server = ThreadingHTTPServer((host, port), CreateRequestHandler(self))
+        logging.info("Inference server listening on {0}:{1}".format(host, port))
+        try:
+            server.serve_forever()
+        finally:
+            server.server_close()
+
+
+def CreateRequestHandler(inferenceServer: InferenceServer):
+    class RequestHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if urlparse(self.path).path != "/metrics":
+                self.send_error(404)
+                return
+            self.Reply(200, "application/json", json.dumps(inferenceServer.Metrics()).encode())
+
+        def do_POST(self):
+            url = urlparse(self.path)
+            if url.path != "/generate":
+                self.send_error(404)
+                return
+            query = parse_qs(url.query)
+            try:
+                size = int(query.get("size", [next(iter(inferenceServer.Batchers))])[0])
+                shift = int(query.get("shift", [size])[0])
+                body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+                image = cv2.imdecode(np.frombuffer(body, dtype=np.uint8), cv2.IMREAD_COLOR)
+                if image is None:
+                    raise ValueError("The request does not contain a readable image!")
+                result = inferenceServer.Generate(image, size, shift)
+            except ValueError as e:
+                self.send_error(400, str(e))
+                return
+            except Exception as e:
+                # a failed request must still get a reply instead of a dropped connection
+                logging.exception("Generation failed")
+                self.send_error(500, str(e))
+                return
+            self.Reply(200, "image/png", cv2.imencode(".png", result)[1].tobytes())
+
+        def Reply(self, code: int, contentType: str, body: bytes):
+            self.send_response(code)
+            self.send_header("Content-Type", contentType)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            logging.debug("Server: " + format % args)
+
+    return RequestHandler
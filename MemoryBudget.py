@@ -0,0 +1,129 @@
+import logging
+import os
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+MB = 1024 * 1024
+
+
+def PeakRSS() -> int:
+    # VmHWM can be reset between stages, ru_maxrss only ever grows
+    if os.path.isfile("/proc/self/status"):
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) * 1024
+    if resource is not None:
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # kilobytes on Linux, bytes on macOS
+        return peak if peak > 1 << 32 else peak * 1024
+    return 0
+
+
+def ResetPeakRSS() -> bool:
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+        return True
+    except OSError:
+        return False
+
+
+def TileBytes(windowSize: int) -> int:
+    return windowSize * windowSize * 3
+
+
+def ActivationBytes(windowSize: int, training: bool = False) -> int:
+    # float32 outputs of every layer for one window, the pooled layers are a sixteenth of the size
+    channels = 3 + 3 + 15 + 15 + 30 / 16 + 30 / 16 + 30 + 30 + 15 + 15 + 3
+    activations = int(4 * windowSize * windowSize * channels)
+    # the backward pass keeps the activations and adds gradients of the same size
+    return activations * 2 if training else activations
+
+
+class MemoryBudget:
+    def __init__(self):
+        self.Limit = 0  # bytes, 0 means no budget
+        self.DatasetShare = 0.5
+        self.BatchShare = 0.25
+        self.Stages = []  # the open stages, innermost last
+
+    def SetLimit(self, limit: int):
+        self.Limit = limit
+        logging.info("Memory budget set to {0:.0f} MB".format(limit / MB))
+
+    def Fit(self, requested: int, itemBytes: int, share: float, name: str) -> int:
+        if self.Limit <= 0 or requested <= 0:
+            return requested
+        count = max(1, min(requested, int(self.Limit * share) // max(1, itemBytes)))
+        if count < requested:
+            logging.info("{0} reduced from {1} to {2} to fit {3:.0f} MB".format(
+                name, requested, count, self.Limit * share / MB))
+        return count
+
+    def DatasetCount(self, windowSize: int, requested: int) -> int:
+        # an RGB and a normal tile per sample, both kept as uint8
+        return self.Fit(requested, 2 * TileBytes(windowSize), self.DatasetShare, "Dataset size")
+
+    def TrainingBatchSize(self, windowSize: int, requested: int, prefetch: int = 0) -> int:
+        # the queued batches hold tiles only, the batch on the model holds every activation
+        sampleBytes = ActivationBytes(windowSize, True) + (prefetch + 1) * 2 * TileBytes(windowSize)
+        return self.Fit(requested, sampleBytes, self.BatchShare, "Training batch size")
+
+    def InferenceBatchSize(self, windowSize: int, requested: int) -> int:
+        return self.Fit(requested, ActivationBytes(windowSize) + TileBytes(windowSize), self.BatchShare,
+                        "Inference batch size")
+
+    def StripHeight(self, width: int, requested: int, alignment: int = 4) -> int:
+        # a strip is predicted in one pass, its activations are those of a window as wide as the image
+        rowBytes = ActivationBytes(1) * width
+        height = self.Fit(requested, rowBytes, self.BatchShare, "Strip height")
+        return max(alignment, height - height % alignment)
+
+    @staticmethod
+    def CanvasBytes(height: int, width: int) -> int:
+        # float32 sums and weights of the overlap-add plus the uint8 result
+        return height * width * (3 * 4 + 4 + 3)
+
+    def Stage(self, name: str, estimate: int = 0):
+        return MemoryStage(self, name, estimate)
+
+
+class MemoryStage:
+    def __init__(self, budget: MemoryBudget, name: str, estimate: int):
+        self.Budget = budget
+        self.Name = name
+        self.Estimate = estimate
+        self.Peak = 0
+
+    def __enter__(self):
+        if self.Budget.Limit > 0 and self.Estimate > self.Budget.Limit:
+            logging.warning("{0} is estimated at {1:.0f} MB, over the budget of {2:.0f} MB".format(
+                self.Name, self.Estimate / MB, self.Budget.Limit / MB))
+        # resetting the high-water mark loses the peak of the enclosing stage, so it is kept there first
+        if len(self.Budget.Stages) > 0:
+            parent = self.Budget.Stages[-1]
+            parent.Peak = max(parent.Peak, PeakRSS())
+        self.Budget.Stages.append(self)
+        self.Reset = ResetPeakRSS()
+        return self
+
+    def __exit__(self, excType, excValue, traceback):
+        self.Budget.Stages.remove(self)
+        peak = max(self.Peak, PeakRSS())
+        if len(self.Budget.Stages) > 0:
+            parent = self.Budget.Stages[-1]
+            parent.Peak = max(parent.Peak, peak)
+        scope = "" if self.Reset else " (process peak)"
+        if self.Estimate > 0:
+            logging.info("{0}: estimated {1:.1f} MB, peak RSS {2:.1f} MB{3}".format(
+                self.Name, self.Estimate / MB, peak / MB, scope))
+        else:
+            logging.info("{0}: peak RSS {1:.1f} MB{2}".format(self.Name, peak / MB, scope))
+        return False
+
+
+Memory = MemoryBudget()
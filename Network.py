@@ -1,13 +1,23 @@
+import contextlib
+import json
+import logging
 import os.path
-import matplotlib.pyplot as plt
+import shutil
+import tempfile
+import time
 import keras.models
 from keras.models import Model
-from keras.layers import Input, Conv2D, AveragePooling2D, UpSampling2D, BatchNormalization, Layer, InputSpec
+from keras.layers import Input, Conv2D, AveragePooling2D, UpSampling2D, BatchNormalization, Layer, InputSpec, Rescaling
 from keras.optimizers import Adam
-from keras.callbacks import ModelCheckpoint
+from keras.callbacks import ModelCheckpoint, Callback, EarlyStopping, ReduceLROnPlateau, BackupAndRestore
 import numpy as np
 import tensorflow as tf
 from Dataset import Dataset
+from WindowedPredictor import PredictFullImage, PredictStrips
+from NumpyNetwork import FoldBatchNorm
+from ResultCache import HashModel
+from Tracing import Trace
+from MemoryBudget import Memory, ActivationBytes, TileBytes
 
 class ReflectionPadding2D(Layer):
     def __init__(self, padding=(1, 1), **kwargs):
@@ -22,6 +32,112 @@ class ReflectionPadding2D(Layer):
         return tf.pad(input_tensor, [[0,0], [padding_height, padding_height], [padding_width, padding_width], [0,0] ], 'REFLECT')
 
 
+def ScaledMeanSquaredError(yTrue, yPred):
+    # the target normals arrive as uint8, like the inputs they are only scaled on the device
+    yTrue = tf.cast(yTrue, yPred.dtype) / 255
+    return tf.reduce_mean(tf.square(yPred - yTrue), axis=-1)
+
+
+CustomObjects = {"ReflectionPadding2D": ReflectionPadding2D, "ScaledMeanSquaredError": ScaledMeanSquaredError}
+
+
+class EpochTrace(Callback):
+    def __init__(self):
+        super(EpochTrace, self).__init__()
+        self.Start = 0.0
+
+    def on_epoch_begin(self, epoch, logs=None):
+        self.Start = time.perf_counter()
+
+    def on_epoch_end(self, epoch, logs=None):
+        Trace.Record("training epoch", self.Start, time.perf_counter(), {"items": 1})
+
+
+class ThroughputLog(Callback):
+    def __init__(self, samplesPerEpoch: int):
+        super(ThroughputLog, self).__init__()
+        self.SamplesPerEpoch = samplesPerEpoch
+        self.SamplesPerSecond = []
+        self.Start = 0.0
+
+    def on_epoch_begin(self, epoch, logs=None):
+        self.Start = time.perf_counter()
+
+    def on_epoch_end(self, epoch, logs=None):
+        rate = self.SamplesPerEpoch / (time.perf_counter() - self.Start)
+        self.SamplesPerSecond.append(rate)
+        logging.info("Epoch {0}: {1:.1f} samples/s".format(epoch + 1, rate))
+
+
+class ConvergenceLog(Callback):
+    def __init__(self, targetLoss: float = 0.0, statePath: str = None):
+        super(ConvergenceLog, self).__init__()
+        self.TargetLoss = targetLoss
+        self.StatePath = statePath
+        self.Start = 0.0
+        self.Epochs = 0
+        self.BestLoss = None
+        self.BestEpoch = 0
+        self.TargetEpoch = None
+        self.TargetSeconds = None
+
+    def on_train_begin(self, logs=None):
+        self.Start = time.perf_counter()
+
+    def on_epoch_end(self, epoch, logs=None):
+        loss = (logs or {}).get("val_loss")
+        self.Epochs = epoch + 1
+        if loss is None:
+            return
+        if self.BestLoss is None or loss < self.BestLoss:
+            self.BestLoss = loss
+            self.BestEpoch = epoch + 1
+            if self.StatePath is not None and os.path.isdir(os.path.dirname(self.StatePath)):
+                with open(self.StatePath, "w") as f:
+                    json.dump({"bestLoss": float(loss), "bestEpoch": self.BestEpoch}, f)
+        if self.TargetEpoch is None and 0 < self.TargetLoss and loss <= self.TargetLoss:
+            self.TargetEpoch = epoch + 1
+            self.TargetSeconds = time.perf_counter() - self.Start
+            logging.info("Target loss {0} reached after {1} epochs and {2:.1f}s".format(
+                self.TargetLoss, self.TargetEpoch, self.TargetSeconds))
+
+    def RestoreState(self):
+        # the best loss of an interrupted run, kept next to the backup that resumes it.
+        # without a checkpoint in the backup nothing is resumed, and the file is left from an older run
+        if self.StatePath is None or not os.path.isfile(self.StatePath):
+            return
+        backupPath = os.path.dirname(self.StatePath)
+        checkpoints = [os.path.join(root, f) for root, _, files in os.walk(backupPath) for f in files]
+        if all(os.path.samefile(f, self.StatePath) for f in checkpoints):
+            return
+        with open(self.StatePath) as f:
+            state = json.load(f)
+        self.BestLoss = state["bestLoss"]
+        self.BestEpoch = state["bestEpoch"]
+        logging.info("Resuming with the best loss {0} of epoch {1}".format(self.BestLoss, self.BestEpoch))
+
+    def Summary(self) -> dict:
+        return {"epochs": self.Epochs, "seconds": time.perf_counter() - self.Start, "bestLoss": self.BestLoss,
+                "bestEpoch": self.BestEpoch, "targetLoss": self.TargetLoss, "targetEpoch": self.TargetEpoch,
+                "targetSeconds": self.TargetSeconds}
+
+
+def CreateStrategy():
+    # every process started with a TF_CONFIG joins the cluster described in it
+    if "TF_CONFIG" not in os.environ:
+        return None
+    return tf.distribute.MultiWorkerMirroredStrategy()
+
+
+def IsChief(strategy) -> bool:
+    if strategy is None:
+        return True
+    resolver = strategy.cluster_resolver
+    if resolver is None or resolver.task_type is None:
+        return True
+    return resolver.task_type == "chief" or (resolver.task_type == "worker" and resolver.task_id == 0)
+
+
 class NormalGeneratorNetwork:
 
     def __init__(self, datasetDirectory: str, imageSize: int, trainingSet: Dataset = None, testingSet: Dataset = None):
@@ -31,12 +147,32 @@ class NormalGeneratorNetwork:
         self.TrainingDataset = trainingSet
         self.TestingDataset = testingSet
         self.Model = None  # type: keras.Model
+        self.FullImageModel = None  # type: keras.Model
         self.TrainingEpochs = 100
+        self.BatchSize = 32
+        self.PrefetchBatches = 8
+        self.PoolingFactor = 4
+        self.StripHalo = 32
+        self.LearningRate = 0.001
+        self.StoppingPatience = 10
+        self.PlateauPatience = 4
+        self.PlateauFactor = 0.5
+        self.MinimumLearningRate = 1e-6
+        self.TargetLoss = 0.0
+        self.TrainingSummary = None
+        self.Strategy = None  # type: tf.distribute.Strategy
+        self.SamplesPerSecond = []
 
-    def CreateModel(self):
-        inputImg = Input(shape=(self.ImageSize, self.ImageSize, 3))
-
-        conv = ReflectionPadding2D()(inputImg)
+    def BuildGraph(self, inputShape: tuple, scaledInput: bool = False) -> Model:
+        if scaledInput:
+            # [0, 1] float inputs, for converters that carry the scaling in the input quantization
+            inputImg = Input(shape=inputShape, dtype='float32')
+            conv = inputImg
+        else:
+            inputImg = Input(shape=inputShape, dtype='uint8')
+            # pixels stay uint8 up to the model, the scaling is part of the saved graph
+            conv = Rescaling(1 / 255)(inputImg)
+        conv = ReflectionPadding2D()(conv)
         conv = Conv2D(15, (3, 3), activation='relu', padding='valid', use_bias=False)(conv)
         conv = BatchNormalization()(conv)
         conv = ReflectionPadding2D()(conv)
@@ -50,8 +186,20 @@ class NormalGeneratorNetwork:
         conv = BatchNormalization()(conv)
         conv = ReflectionPadding2D()(conv)
         conv = Conv2D(3, (3, 3), activation='relu', padding='valid')(conv)
-        generator = Model(inputImg, conv)
-        generator.compile(Adam(amsgrad=True), loss='mse')
+        return Model(inputImg, conv)
+
+    def ReplicaCount(self) -> int:
+        return 1 if self.Strategy is None else self.Strategy.num_replicas_in_sync
+
+    def Scope(self):
+        return self.Strategy.scope() if self.Strategy is not None else contextlib.nullcontext()
+
+    def CreateModel(self):
+        with self.Scope():
+            generator = self.BuildGraph((self.ImageSize, self.ImageSize, 3))
+            # every replica takes a full batch, the learning rate grows with the global batch
+            generator.compile(Adam(learning_rate=self.LearningRate * self.ReplicaCount(), amsgrad=True),
+                              loss=ScaledMeanSquaredError)
 
         self.Model = generator
 
@@ -60,9 +208,9 @@ class NormalGeneratorNetwork:
 
     def Train(self):
         if self.TrainingDataset is None:
-            self.TrainingDataset = Dataset(self.WorkingDirectory, 1000, True, True)
+            self.TrainingDataset = Dataset(self.WorkingDirectory, 1000, True, True, imageSize=self.ImageSize)
         if self.TestingDataset is None:
-            self.TestingDataset = Dataset(self.WorkingDirectory, 100, True, False)
+            self.TestingDataset = Dataset(self.WorkingDirectory, 100, True, False, imageSize=self.ImageSize)
 
         if not self.TrainingDataset.IsLoaded:
             self.TrainingDataset.Load()
@@ -71,30 +219,68 @@ class NormalGeneratorNetwork:
 
         # load model if not exists
         self.PrepareModel()
-        # Training cycle
-        trainingRGB = np.asarray(self.TrainingDataset.Dataset[0])
-        trainingNormal = np.asarray(self.TrainingDataset.Dataset[1])
-
-        testingRGB = np.asarray(self.TestingDataset.Dataset[0])
-        testingNormal = np.asarray(self.TestingDataset.Dataset[1])
 
+        # every worker has to save, but only the chief writes to the model path
+        chief = IsChief(self.Strategy)
+        backupPath = self.ModelPath + "_backup"
+        convergence = ConvergenceLog(self.TargetLoss, os.path.join(backupPath, "best_loss.json"))
+        convergence.RestoreState()
+        if not chief:
+            convergence.StatePath = None
+        checkpointPath = self.ModelPath if chief else tempfile.mkdtemp(prefix="checkpoint_")
         checkpoint = ModelCheckpoint(
-            filepath=self.ModelPath,
+            filepath=checkpointPath,
             save_weights_only=False,
-            mode='max',
-            save_best_only=True
+            monitor='val_loss',
+            mode='min',
+            save_best_only=True,
+            # a resumed run must not overwrite the model saved before the interruption with a worse one
+            initial_value_threshold=convergence.BestLoss
         )
+        callbacks = [
+            # the backup holds the weights, the optimizer state and the epoch, an interrupted run resumes from it
+            BackupAndRestore(backup_dir=backupPath),
+            checkpoint,
+            ReduceLROnPlateau(monitor='val_loss', mode='min', factor=self.PlateauFactor,
+                              patience=self.PlateauPatience, min_lr=self.MinimumLearningRate),
+            EarlyStopping(monitor='val_loss', mode='min', patience=self.StoppingPatience, restore_best_weights=True),
+            convergence
+        ]
+        if Trace.Enabled:
+            callbacks.append(EpochTrace())
 
-        history = self.Model.fit(trainingRGB, trainingNormal,
-                                 validation_data=(testingRGB, testingNormal),
-                                 batch_size=32,
-                                 epochs=self.TrainingEpochs,
-                                 callbacks=[checkpoint])
+        # Training cycle
+        self.BatchSize = Memory.TrainingBatchSize(self.ImageSize, self.BatchSize, self.PrefetchBatches)
+        estimate = self.BatchSize * (ActivationBytes(self.ImageSize, True) +
+                                     (self.PrefetchBatches + 1) * 2 * TileBytes(self.ImageSize))
+        try:
+            with Memory.Stage("training " + str(self.ImageSize), estimate):
+                if self.ReplicaCount() > 1:
+                    history = self.FitDistributed(callbacks)
+                else:
+                    history = self.Fit(callbacks)
+        finally:
+            if not chief:
+                shutil.rmtree(checkpointPath, ignore_errors=True)
+        # keras removes only its own checkpoint from the backup directory, a finished run resumes nothing
+        if chief and os.path.isfile(convergence.StatePath):
+            os.unlink(convergence.StatePath)
+        # the best model may come from before a resume, the weights of this run alone do not know about it
+        self.LoadModel()
+        self.FullImageModel = None
+        self.TrainingSummary = convergence.Summary()
+        logging.info("Training of size {0} stopped after {1} epochs in {2:.1f}s, best loss {3} in epoch {4}".format(
+            self.ImageSize, self.TrainingSummary["epochs"], self.TrainingSummary["seconds"],
+            self.TrainingSummary["bestLoss"], self.TrainingSummary["bestEpoch"]))
+        if not chief:
+            return
 
         # plotting the loss
+        import matplotlib.pyplot as plt
         losses = history.history["loss"]
         valLosses = history.history["val_loss"]
-        epochs = np.arange(0, self.TrainingEpochs)
+        # early stopping and resuming change the number of epochs in the history
+        epochs = np.arange(0, len(losses))
         fig = plt.figure()
         plt.ion()
         plt.plot(epochs, losses, '-b', label="Epoch loss")
@@ -108,12 +294,138 @@ class NormalGeneratorNetwork:
         path = os.path.join(path, "loss_" + str(self.ImageSize) + ".png")
         plt.savefig(path)
 
-    def Predict(self, image: np.ndarray, verbose: bool = True):
+    def Fit(self, callbacks: list):
+        if self.TestingDataset.Streaming:
+            validation = self.TestingDataset.Batches(self.BatchSize, False)
+        else:
+            validation = (self.TestingDataset.Dataset[0], self.TestingDataset.Dataset[1])
+
+        if self.TrainingDataset.Streaming:
+            batches = self.TrainingDataset.Batches(self.BatchSize)
+            throughput = ThroughputLog(len(batches) * self.BatchSize)
+            history = self.Model.fit(batches,
+                                     validation_data=validation,
+                                     epochs=self.TrainingEpochs,
+                                     callbacks=callbacks + [throughput],
+                                     max_queue_size=self.PrefetchBatches,
+                                     workers=2)
+        else:
+            throughput = ThroughputLog(self.TrainingDataset.Dataset[0].shape[0])
+            history = self.Model.fit(self.TrainingDataset.Dataset[0], self.TrainingDataset.Dataset[1],
+                                     validation_data=validation,
+                                     batch_size=self.BatchSize,
+                                     epochs=self.TrainingEpochs,
+                                     callbacks=callbacks + [throughput])
+        self.SamplesPerSecond = throughput.SamplesPerSecond
+        return history
+
+    def FitDistributed(self, callbacks: list):
+        if not self.TrainingDataset.Streaming or not self.TestingDataset.Streaming:
+            raise ValueError("Distributed training needs streaming datasets!")
+        # each worker reads its own share of the batches, the replicas average their gradients every step.
+        # the workers shuffle alike, so their shares stay disjoint
+        np.random.seed(0)
+        training = self.TrainingDataset.Batches(self.BatchSize)
+        testing = self.TestingDataset.Batches(self.BatchSize, False)
+        steps = len(training) // self.ReplicaCount()
+        validationSteps = max(1, len(testing) // self.ReplicaCount())
+        if steps == 0:
+            raise ValueError("There are fewer training batches than workers!")
+        throughput = ThroughputLog(steps * self.BatchSize * self.ReplicaCount())
+        history = self.Model.fit(self.DistributeBatches(training, steps),
+                                 steps_per_epoch=steps,
+                                 validation_data=self.DistributeBatches(testing, validationSteps),
+                                 validation_steps=validationSteps,
+                                 epochs=self.TrainingEpochs,
+                                 callbacks=callbacks + [throughput])
+        self.SamplesPerSecond = throughput.SamplesPerSecond
+        return history
+
+    def DistributeBatches(self, sequence, steps: int):
+        signature = (tf.TensorSpec((None, self.ImageSize, self.ImageSize, 3), tf.uint8),
+                     tf.TensorSpec((None, self.ImageSize, self.ImageSize, 3), tf.uint8))
+
+        def Pipeline(context: tf.distribute.InputContext):
+            def Generate():
+                # the last batches are dropped, so every worker runs the same number of steps
+                while True:
+                    for index in range(context.input_pipeline_id, steps * context.num_input_pipelines,
+                                       context.num_input_pipelines):
+                        yield sequence[index]
+                    sequence.on_epoch_end()
+            dataset = tf.data.Dataset.from_generator(Generate, output_signature=signature)
+            return dataset.prefetch(self.PrefetchBatches)
+
+        return self.Strategy.distribute_datasets_from_function(Pipeline)
+
+    def Predict(self, image: np.ndarray, verbose: bool = True, batchSize: int = None):
         self.PrepareModel()
         v = 0 if verbose is False else 1
-        result = self.Model.predict(image, verbose=v)
+        with Trace.Span("predict batch", items=image.shape[0]):
+            result = self.Model.predict(image, batch_size=batchSize, verbose=v)
         return result
 
+    def PrepareFullImageModel(self):
+        self.PrepareModel()
+        if self.FullImageModel is None:
+            # the graph has no dense layers, so the trained weights fit any input size
+            self.FullImageModel = self.BuildGraph((None, None, 3))
+            self.FullImageModel.set_weights(self.Model.get_weights())
+
+    def PredictFullImage(self, image: np.ndarray, stripHeight: int = 0) -> np.ndarray:
+        self.PrepareFullImageModel()
+        forward = lambda x: np.asarray(self.FullImageModel(x, training=False))
+        return PredictFullImage(forward, image, stripHeight, self.PoolingFactor, self.StripHalo)
+
+    def PredictStrips(self, image: np.ndarray, stripHeight: int):
+        self.PrepareFullImageModel()
+        forward = lambda x: np.asarray(self.FullImageModel(x, training=False))
+        return PredictStrips(forward, image, stripHeight, self.PoolingFactor, self.StripHalo)
+
+    def ExportFoldedWeights(self, path: str = None) -> str:
+        self.PrepareModel()
+        if path is None:
+            path = self.ModelPath + ".npz"
+
+        # every batch-norm follows a relu, so it is folded into the next convolution instead of the previous one
+        weights = {}
+        count = 0
+        pendingNorm = None
+        for layer in self.Model.layers:
+            if isinstance(layer, Rescaling):
+                # the input scaling is a batch-norm without statistics, so it folds into the first convolution
+                channels = layer.input.shape[-1]
+                pendingNorm = (np.full(channels, layer.scale, dtype=np.float32),
+                               np.full(channels, layer.offset, dtype=np.float32),
+                               np.zeros(channels, dtype=np.float32), np.ones(channels, dtype=np.float32), 0.0)
+            elif isinstance(layer, BatchNormalization):
+                gamma, beta, mean, variance = layer.get_weights()
+                pendingNorm = (gamma, beta, mean, variance, layer.epsilon)
+            elif isinstance(layer, Conv2D):
+                layerWeights = layer.get_weights()
+                kernel = layerWeights[0]
+                bias = layerWeights[1] if len(layerWeights) > 1 else np.zeros(kernel.shape[3], dtype=np.float32)
+                if pendingNorm is not None:
+                    kernel, bias = FoldBatchNorm(kernel, bias, *pendingNorm)
+                    pendingNorm = None
+                weights["kernel_" + str(count)] = kernel.astype(np.float32)
+                weights["bias_" + str(count)] = bias.astype(np.float32)
+                count += 1
+        if pendingNorm is not None:
+            raise ValueError("The last batch normalization has no convolution to be folded into!")
+
+        np.savez(path, count=count, inputRange=255, **weights)
+        logging.info("Exported {0} folded convolutions to {1}".format(count, path))
+        return path
+
+    def CheckParity(self, numpyNetwork, count: int = 8) -> float:
+        self.PrepareModel()
+        samples = np.random.randint(0, 256, (count, self.ImageSize, self.ImageSize, 3), dtype=np.uint8)
+        expected = self.Predict(samples, False)
+        difference = float(np.abs(numpyNetwork.Predict(samples, False) - expected).max())
+        logging.info("Largest difference between the Keras and NumPy outputs: {0}".format(difference))
+        return difference
+
     def SaveModel(self, overwrite: bool = False):
         if self.IsModelExists():
             if not overwrite:
@@ -124,9 +436,19 @@ class NormalGeneratorNetwork:
 
     def LoadModel(self):
         if self.IsModelExists():
-            self.Model = keras.models.load_model(self.ModelPath)
+            with Trace.Span("model load"), self.Scope():
+                self.Model = keras.models.load_model(self.ModelPath, custom_objects=CustomObjects)
+            if not any(isinstance(layer, Rescaling) for layer in self.Model.layers):
+                # older models expect inputs scaled on the host, their weights fit the new graph unchanged
+                logging.info("Adding the input scaling to the model at " + self.ModelPath)
+                weights = self.Model.get_weights()
+                self.CreateModel()
+                self.Model.set_weights(weights)
         # TODO: Error when does not exists
 
+    def ModelDigest(self) -> str:
+        return HashModel(self.ModelPath)
+
     def DeleteModel(self):
         os.unlink(self.ModelPath)
 
@@ -0,0 +1,38 @@
+import numpy as np
+
+
+def DecodeNormals(image: np.ndarray) -> np.ndarray:
+    # [0, 1] or uint8 pixels to unit vectors, the channel order does not matter for the angles
+    normals = np.asarray(image, dtype=np.float32)
+    if np.issubdtype(np.asarray(image).dtype, np.integer):
+        normals = normals / 255
+    normals = normals * 2 - 1
+    length = np.linalg.norm(normals, axis=-1, keepdims=True)
+    return normals / np.maximum(length, 1e-6)
+
+
+def AngularError(predicted: np.ndarray, expected: np.ndarray) -> np.ndarray:
+    # per pixel angle in degrees between two normal maps of the same shape
+    cosine = np.sum(DecodeNormals(predicted) * DecodeNormals(expected), axis=-1)
+    return np.degrees(np.arccos(np.clip(cosine, -1, 1)))
+
+
+def MeanSquaredError(predicted: np.ndarray, expected: np.ndarray) -> float:
+    difference = np.asarray(predicted, dtype=np.float32) - np.asarray(expected, dtype=np.float32)
+    if np.issubdtype(np.asarray(predicted).dtype, np.integer):
+        difference /= 255
+    return float(np.mean(np.square(difference)))
+
+
+def SeamScore(predicted: np.ndarray, expected: np.ndarray, step: int) -> float:
+    # jumps of the error across the window grid against the jumps everywhere else, 1 means no visible seams
+    error = np.asarray(predicted, dtype=np.float32) - np.asarray(expected, dtype=np.float32)
+    jumpX = np.abs(np.diff(error, axis=1)).mean(axis=(0, 2))
+    jumpY = np.abs(np.diff(error, axis=0)).mean(axis=(1, 2))
+    gridX = (np.arange(jumpX.shape[0]) + 1) % step == 0
+    gridY = (np.arange(jumpY.shape[0]) + 1) % step == 0
+    if not gridX.any() and not gridY.any():
+        return 1.0
+    seams = np.concatenate([jumpX[gridX], jumpY[gridY]]).mean()
+    interior = np.concatenate([jumpX[~gridX], jumpY[~gridY]]).mean()
+    return float(seams / max(interior, 1e-6))
@@ -0,0 +1,98 @@
+import logging
+import os.path
+import numpy as np
+from WindowedPredictor import PredictFullImage, PredictStrips
+from ResultCache import HashModel
+from Tracing import Trace
+
+
+def FoldBatchNorm(kernel: np.ndarray, bias: np.ndarray, gamma: np.ndarray, beta: np.ndarray,
+                  mean: np.ndarray, variance: np.ndarray, epsilon: float):
+    # the batch-norm is a per-channel affine map applied to the input of this convolution
+    scale = gamma / np.sqrt(variance + epsilon)
+    shift = beta - mean * scale
+    foldedKernel = kernel * scale[np.newaxis, np.newaxis, :, np.newaxis]
+    foldedBias = bias + np.tensordot(kernel, shift, axes=([2], [0])).sum(axis=(0, 1))
+    return foldedKernel.astype(np.float32), foldedBias.astype(np.float32)
+
+
+def ReflectionPad(x: np.ndarray) -> np.ndarray:
+    return np.pad(x, ((0, 0), (1, 1), (1, 1), (0, 0)), mode='reflect')
+
+
+def Convolve(x: np.ndarray, kernel: np.ndarray, bias: np.ndarray) -> np.ndarray:
+    # im2col through a window view, then a single GEMM over (kh, kw, cin)
+    columns = np.lib.stride_tricks.sliding_window_view(x, kernel.shape[:2], axis=(1, 2))
+    result = np.tensordot(columns, kernel.transpose((2, 0, 1, 3)), axes=([3, 4, 5], [0, 1, 2]))
+    result += bias
+    np.maximum(result, 0, out=result)
+    return result
+
+
+def AveragePool(x: np.ndarray, size: int) -> np.ndarray:
+    height = x.shape[1] // size
+    width = x.shape[2] // size
+    x = x[:, :height * size, :width * size, :]
+    return x.reshape((x.shape[0], height, size, width, size, x.shape[3])).mean(axis=(2, 4), dtype=np.float32)
+
+
+def UpSample(x: np.ndarray, size: int) -> np.ndarray:
+    return np.repeat(np.repeat(x, size, axis=1), size, axis=2)
+
+
+class NumpyNetwork:
+    def __init__(self, datasetDirectory: str, imageSize: int):
+        self.WeightPath = os.path.join(datasetDirectory, "model_" + str(imageSize) + ".npz")
+        self.ImageSize = imageSize
+        self.Kernels = None
+        self.Biases = None
+        self.PoolingFactor = 4
+        self.StripHalo = 32
+        self.ChunkSize = 16
+
+    def IsModelExists(self) -> bool:
+        return os.path.isfile(self.WeightPath)
+
+    def LoadModel(self):
+        with Trace.Span("model load") as span:
+            with np.load(self.WeightPath) as weights:
+                count = int(weights["count"])
+                self.Kernels = [weights["kernel_" + str(i)] for i in range(count)]
+                self.Biases = [weights["bias_" + str(i)] for i in range(count)]
+                if "inputRange" not in weights:
+                    # older exports expect inputs scaled to [0, 1] on the host
+                    self.Kernels[0] = self.Kernels[0] / np.float32(255)
+            span.Add("bytesRead", sum(k.nbytes for k in self.Kernels) + sum(b.nbytes for b in self.Biases))
+        logging.debug("Loaded folded weights from " + self.WeightPath)
+
+    def ModelDigest(self) -> str:
+        return HashModel(self.WeightPath)
+
+    def PrepareModel(self):
+        if self.Kernels is None:
+            self.LoadModel()
+
+    def Forward(self, x: np.ndarray) -> np.ndarray:
+        # the uint8 input scaling is folded into the first kernel, only the chunk being computed is widened
+        x = Convolve(ReflectionPad(x.astype(np.float32)), self.Kernels[0], self.Biases[0])
+        x = ReflectionPad(AveragePool(ReflectionPad(x), self.PoolingFactor))
+        x = Convolve(x, self.Kernels[1], self.Biases[1])
+        x = UpSample(x, self.PoolingFactor)
+        x = Convolve(ReflectionPad(x), self.Kernels[2], self.Biases[2])
+        x = Convolve(ReflectionPad(x), self.Kernels[3], self.Biases[3])
+        return x
+
+    def Predict(self, image: np.ndarray, verbose: bool = True, batchSize: int = None) -> np.ndarray:
+        self.PrepareModel()
+        # the im2col buffers grow with the batch, so it is run in small chunks
+        with Trace.Span("predict batch", items=image.shape[0]):
+            results = [self.Forward(image[i:i + self.ChunkSize]) for i in range(0, image.shape[0], self.ChunkSize)]
+            return np.concatenate(results)
+
+    def PredictFullImage(self, image: np.ndarray, stripHeight: int = 0) -> np.ndarray:
+        self.PrepareModel()
+        return PredictFullImage(self.Forward, image, stripHeight, self.PoolingFactor, self.StripHalo)
+
+    def PredictStrips(self, image: np.ndarray, stripHeight: int):
+        self.PrepareModel()
+        return PredictStrips(self.Forward, image, stripHeight, self.PoolingFactor, self.StripHalo)
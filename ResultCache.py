@@ -0,0 +1,141 @@
+import contextlib
+import hashlib
+import json
+import logging
+import os
+import shutil
+import tempfile
+import numpy as np
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+
+def HashModel(path: str) -> str:
+    # a saved Keras model is a directory, every file in it is part of the weights
+    digest = hashlib.sha1()
+    if os.path.isdir(path):
+        files = sorted(os.path.relpath(os.path.join(root, f), path)
+                       for root, _, names in os.walk(path) for f in names)
+    else:
+        files = [""]
+    for name in files:
+        digest.update(name.encode())
+        with open(os.path.join(path, name) if name else path, "rb") as f:
+            for block in iter(lambda: f.read(1 << 20), b""):
+                digest.update(block)
+    return digest.hexdigest()
+
+
+def HashImage(image: np.ndarray) -> str:
+    digest = hashlib.sha1(str(image.shape).encode())
+    # row by row, so a memory-mapped input is not paged in at once
+    for row in range(image.shape[0]):
+        digest.update(np.ascontiguousarray(image[row]).data)
+    return digest.hexdigest()
+
+
+class ResultCache:
+    LockName = "cache.lock"
+    StatsName = "stats.json"
+
+    def __init__(self, path: str, maxBytes: int = 1 << 30):
+        self.Path = path
+        self.MaxBytes = maxBytes
+        os.makedirs(self.Path, exist_ok=True)
+
+    @staticmethod
+    def Key(image: np.ndarray, modelDigest: str, parameters: dict) -> str:
+        settings = json.dumps(parameters, sort_keys=True)
+        return hashlib.sha1((HashImage(image) + ":" + modelDigest + ":" + settings).encode()).hexdigest()
+
+    @contextlib.contextmanager
+    def Lock(self):
+        # several generating processes may share the folder, eviction and statistics are serialized
+        with open(os.path.join(self.Path, self.LockName), "a") as f:
+            if fcntl is not None:
+                fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                if fcntl is not None:
+                    fcntl.flock(f, fcntl.LOCK_UN)
+
+    def EntryPath(self, key: str, extension: str) -> str:
+        return os.path.join(self.Path, key + extension)
+
+    def Get(self, key: str, outputPath: str) -> bool:
+        entry = self.EntryPath(key, os.path.splitext(outputPath)[1])
+        try:
+            shutil.copyfile(entry, outputPath)
+            # the modification time is the last use, eviction removes the oldest entries first
+            os.utime(entry)
+            hit = True
+        except FileNotFoundError:
+            hit = False
+        self.Count("hits" if hit else "misses")
+        return hit
+
+    def Put(self, key: str, outputPath: str):
+        extension = os.path.splitext(outputPath)[1]
+        # written under a temporary name, a reader never sees a partial entry
+        handle, temporary = tempfile.mkstemp(suffix=".tmp", dir=self.Path)
+        os.close(handle)
+        shutil.copyfile(outputPath, temporary)
+        os.replace(temporary, self.EntryPath(key, extension))
+        self.Evict()
+
+    def Entries(self) -> list:
+        entries = []
+        with os.scandir(self.Path) as scan:
+            for e in scan:
+                if e.is_file() and e.name not in (self.LockName, self.StatsName) and not e.name.endswith(".tmp"):
+                    stat = e.stat()
+                    entries.append((stat.st_mtime_ns, stat.st_size, e.path))
+        return entries
+
+    def Evict(self):
+        with self.Lock():
+            entries = sorted(self.Entries())
+            size = sum(e[1] for e in entries)
+            evicted = 0
+            for _, entrySize, path in entries:
+                if size <= self.MaxBytes:
+                    break
+                with contextlib.suppress(FileNotFoundError):
+                    os.unlink(path)
+                size -= entrySize
+                evicted += 1
+            if evicted > 0:
+                logging.debug("Evicted " + str(evicted) + " cached results")
+                self.UpdateStats({"evictions": evicted})
+
+    def Count(self, name: str):
+        with self.Lock():
+            self.UpdateStats({name: 1})
+
+    def UpdateStats(self, counts: dict):
+        stats = self.ReadStats()
+        for name, count in counts.items():
+            stats[name] = stats.get(name, 0) + count
+        with open(os.path.join(self.Path, self.StatsName), "w") as f:
+            json.dump(stats, f)
+
+    def ReadStats(self) -> dict:
+        path = os.path.join(self.Path, self.StatsName)
+        if not os.path.isfile(path):
+            return {"hits": 0, "misses": 0, "evictions": 0}
+        with open(path, "r") as f:
+            return json.load(f)
+
+    def Stats(self) -> dict:
+        with self.Lock():
+            stats = self.ReadStats()
+            entries = self.Entries()
+        lookups = stats["hits"] + stats["misses"]
+        stats["hitRate"] = stats["hits"] / lookups if lookups > 0 else 0.0
+        stats["entries"] = len(entries)
+        stats["bytes"] = sum(e[1] for e in entries)
+        return stats
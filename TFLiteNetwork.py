@@ -0,0 +1,137 @@
+import logging
+import os
+import os.path
+import time
+import numpy as np
+import tensorflow as tf
+from WindowedPredictor import PredictFullImage, PredictStrips
+from ResultCache import HashModel
+from NormalMetrics import AngularError
+from Tracing import Trace
+
+QuantizationModes = ["dynamic", "int8", "float16"]
+
+
+def QuantizedModelPath(datasetDirectory: str, imageSize: int, mode: str) -> str:
+    return os.path.join(datasetDirectory, "model_" + str(imageSize) + "_" + mode + ".tflite")
+
+
+def ExportQuantized(network, mode: str, calibration: np.ndarray = None) -> str:
+    if mode not in QuantizationModes:
+        raise ValueError("Unknown quantization mode: " + str(mode))
+    # the fully convolutional graph is converted, so the interpreter can be resized to strips and whole images
+    network.PrepareFullImageModel()
+    model = network.FullImageModel
+    if mode == "int8":
+        if calibration is None or calibration.shape[0] == 0:
+            raise ValueError("Full integer quantization needs calibration tiles!")
+        # the uint8 input of the graph would stay a cast and a float scaling in front of the quantized ops,
+        # a copy taking [0, 1] floats lets the converter carry the 1/255 in the input quantization instead
+        model = network.BuildGraph((None, None, 3), scaledInput=True)
+        model.set_weights(network.FullImageModel.get_weights())
+    converter = tf.lite.TFLiteConverter.from_keras_model(model)
+    converter.optimizations = [tf.lite.Optimize.DEFAULT]
+    if mode == "float16":
+        converter.target_spec.supported_types = [tf.float16]
+    elif mode == "int8":
+        def RepresentativeData():
+            # a black and a white tile pin the input range to [0, 1], so the input scale is exactly 1/255
+            # and raw uint8 pixels go into the model as they are
+            for value in (0, 1):
+                yield [np.full((1,) + calibration.shape[1:], value, dtype=np.float32)]
+            for tile in calibration:
+                yield [tile[np.newaxis].astype(np.float32) / 255]
+        converter.representative_dataset = RepresentativeData
+        converter.target_spec.supported_ops = [tf.lite.OpsSet.TFLITE_BUILTINS_INT8]
+        converter.inference_input_type = tf.uint8
+
+    path = QuantizedModelPath(network.WorkingDirectory, network.ImageSize, mode)
+    with Trace.Span("quantize", items=1):
+        model = converter.convert()
+    with open(path, "wb") as f:
+        f.write(model)
+    logging.info("Exported the {0} model of size {1} to {2}".format(mode, network.ImageSize, path))
+    return path
+
+
+def CompareQuantized(network, variants: list, samples: np.ndarray, repeat: int = 3) -> list:
+    # every variant is measured on the same tiles against the float model
+    def Measure(predict):
+        predicted = predict(samples)
+        start = time.perf_counter()
+        for _ in range(repeat):
+            predict(samples)
+        return predicted, samples.shape[0] * repeat / (time.perf_counter() - start)
+
+    expected, rate = Measure(lambda x: network.Predict(x, False, x.shape[0]))
+    savedBytes = sum(os.path.getsize(os.path.join(root, f)) for root, _, files in os.walk(network.ModelPath)
+                     for f in files)
+    rows = [{"mode": "float32", "bytes": savedBytes, "windowsPerSecond": rate, "angularError": 0.0}]
+    for variant in variants:
+        predicted, rate = Measure(lambda x: variant.Predict(x, False, x.shape[0]))
+        rows.append({"mode": variant.Mode, "bytes": os.path.getsize(variant.ModelPath), "windowsPerSecond": rate,
+                     "angularError": float(AngularError(np.clip(predicted, 0, 1), np.clip(expected, 0, 1)).mean())})
+    return rows
+
+
+class TFLiteNetwork:
+    def __init__(self, datasetDirectory: str, imageSize: int, mode: str):
+        self.ModelPath = QuantizedModelPath(datasetDirectory, imageSize, mode)
+        self.ImageSize = imageSize
+        self.Mode = mode
+        self.Interpreter = None  # type: tf.lite.Interpreter
+        self.InputShape = None
+        self.PoolingFactor = 4
+        self.StripHalo = 32
+        self.Threads = os.cpu_count() or 1
+
+    def IsModelExists(self) -> bool:
+        return os.path.isfile(self.ModelPath)
+
+    def LoadModel(self):
+        with Trace.Span("model load", bytesRead=os.path.getsize(self.ModelPath)):
+            # the default op resolver applies the XNNPACK delegate on the CPU
+            self.Interpreter = tf.lite.Interpreter(model_path=self.ModelPath, num_threads=self.Threads)
+        self.InputShape = None
+        logging.debug("Loaded the {0} model from {1}".format(self.Mode, self.ModelPath))
+
+    def ModelDigest(self) -> str:
+        return HashModel(self.ModelPath)
+
+    def PrepareModel(self):
+        if self.Interpreter is None:
+            self.LoadModel()
+
+    def Forward(self, x: np.ndarray) -> np.ndarray:
+        inputDetails = self.Interpreter.get_input_details()[0]
+        if self.InputShape != x.shape:
+            self.Interpreter.resize_tensor_input(inputDetails["index"], x.shape)
+            self.Interpreter.allocate_tensors()
+            self.InputShape = x.shape
+        scale, zeroPoint = inputDetails["quantization"]
+        if scale != 0 and (abs(scale * 255 - 1) > 1e-6 or zeroPoint != 0):
+            # the calibration tiles did not span the full pixel range, the pixels are moved onto the input scale
+            x = np.clip(np.round(x.astype(np.float32) / 255 / scale + zeroPoint), 0, 255)
+        self.Interpreter.set_tensor(inputDetails["index"], np.ascontiguousarray(x, dtype=inputDetails["dtype"]))
+        self.Interpreter.invoke()
+        outputDetails = self.Interpreter.get_output_details()[0]
+        result = self.Interpreter.get_tensor(outputDetails["index"])
+        scale, zeroPoint = outputDetails["quantization"]
+        if scale != 0:
+            result = (result.astype(np.float32) - zeroPoint) * scale
+        return result.astype(np.float32, copy=False)
+
+    def Predict(self, image: np.ndarray, verbose: bool = True, batchSize: int = None) -> np.ndarray:
+        self.PrepareModel()
+        batchSize = batchSize if batchSize is not None else 32
+        with Trace.Span("predict batch", items=image.shape[0]):
+            results = [self.Forward(image[i:i + batchSize]) for i in range(0, image.shape[0], batchSize)]
+            return np.concatenate(results)
+
+    def PredictFullImage(self, image: np.ndarray, stripHeight: int = 0) -> np.ndarray:
+        self.PrepareModel()
+        return PredictFullImage(self.Forward, image, stripHeight, self.PoolingFactor, self.StripHalo)
+
+    def PredictStrips(self, image: np.ndarray, stripHeight: int):
+        self.PrepareModel()
+        return PredictStrips(self.Forward, image, stripHeight, self.PoolingFactor, self.StripHalo)
@@ -0,0 +1,103 @@
+import hashlib
+import json
+import logging
+import os
+import numpy as np
+
+
+def HashSourcePair(rgbPath: str, normalPath: str) -> str:
+    digest = hashlib.sha1()
+    for path in (rgbPath, normalPath):
+        with open(path, "rb") as f:
+            for block in iter(lambda: f.read(1 << 20), b""):
+                digest.update(block)
+    return digest.hexdigest()
+
+
+class TileCache:
+    FileName = "cache.json"
+
+    def __init__(self, path: str, windowSize: int, windowStep: int):
+        self.Path = path
+        self.WindowSize = windowSize
+        self.WindowStep = windowStep
+        self.Entries = {}  # content key -> shards, count, columns, windows, complete
+        self.Files = {}  # source name -> size, mtime, content key
+
+    def IsCacheValid(self) -> bool:
+        return os.path.isfile(os.path.join(self.Path, self.FileName))
+
+    def Open(self) -> bool:
+        with open(os.path.join(self.Path, self.FileName), "r") as f:
+            cache = json.load(f)
+        if cache["windowSize"] != self.WindowSize or cache["windowStep"] != self.WindowStep:
+            return False
+        self.Entries = cache["entries"]
+        self.Files = cache["files"]
+        return True
+
+    def Save(self):
+        cache = {"windowSize": self.WindowSize, "windowStep": self.WindowStep,
+                 "entries": self.Entries, "files": self.Files}
+        with open(os.path.join(self.Path, self.FileName), "w") as f:
+            json.dump(cache, f)
+
+    def SourceKey(self, name: str, rgbPath: str, normalPath: str, digests: dict = None) -> str:
+        rgbStat = os.stat(rgbPath)
+        normalStat = os.stat(normalPath)
+        signature = [rgbStat.st_size, rgbStat.st_mtime_ns, normalStat.st_size, normalStat.st_mtime_ns]
+        # unchanged size and modification time means the content does not have to be hashed again
+        known = self.Files.get(name)
+        if known is not None and known[:4] == signature:
+            return known[4]
+        # the file digest is shared between the pyramid levels, only the window settings differ
+        digest = digests.get(name) if digests is not None else None
+        if digest is None:
+            digest = HashSourcePair(rgbPath, normalPath)
+            if digests is not None:
+                digests[name] = digest
+        settings = (digest + ":" + str(self.WindowSize) + ":" + str(self.WindowStep)).encode()
+        key = hashlib.sha1(settings).hexdigest()[:20]
+        self.Files[name] = signature + [key]
+        return key
+
+    @staticmethod
+    def IndexFileName(key: str) -> str:
+        return "index_" + key + ".npy"
+
+    def GetEntry(self, key: str):
+        entry = self.Entries.get(key)
+        # entries written before the deduplication have no window index and are tiled again.
+        # an incomplete entry still holds the first tiles of its source, they are reused as they are
+        if entry is None or "windows" not in entry:
+            return None
+        return entry
+
+    def SetEntry(self, key: str, shards: list, count: int, columns: int, windows: int, complete: bool):
+        self.Entries[key] = {"shards": shards, "count": count, "columns": columns, "windows": windows,
+                             "complete": complete}
+
+    def ReadIndex(self, key: str):
+        # window number and reference count of every stored tile of the source
+        index = np.load(os.path.join(self.Path, self.IndexFileName(key)))
+        return index[:, 0], index[:, 1]
+
+    def CollectGarbage(self, names: list, keys: list):
+        usedKeys = set(keys)
+        self.Files = {name: self.Files[name] for name in names if name in self.Files}
+        removed = [key for key in self.Entries if key not in usedKeys]
+        for key in removed:
+            del self.Entries[key]
+
+        referenced = set(self.IndexFileName(key) for key in self.Entries)
+        for entry in self.Entries.values():
+            for name, _ in entry["shards"]:
+                referenced.add("rgb_" + name + ".npy")
+                referenced.add("normal_" + name + ".npy")
+        deleted = 0
+        for f in os.listdir(self.Path):
+            if f.endswith(".npy") and f not in referenced:
+                os.unlink(os.path.join(self.Path, f))
+                deleted += 1
+        if len(removed) > 0 or deleted > 0:
+            logging.debug("Removed " + str(len(removed)) + " stale sources and " + str(deleted) + " shard files")
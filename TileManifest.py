@@ -0,0 +1,108 @@
+import os
+import numpy as np
+
+TrainingSplit = 0
+TestingSplit = 1
+UnassignedSplit = 255
+
+
+class TileManifest:
+    FileName = "manifest.npz"
+
+    def __init__(self, path: str):
+        self.Path = path
+        self.Sources = []
+        self.Keys = []  # cache key of every source, tiles of an unchanged source keep their split
+        self.SourceIds = {}
+        self.Source = np.zeros(0, dtype=np.int32)
+        self.Y = np.zeros(0, dtype=np.int32)
+        self.X = np.zeros(0, dtype=np.int32)
+        self.Split = np.zeros(0, dtype=np.uint8)
+        self.References = np.zeros(0, dtype=np.uint32)
+        self.Pending = []
+
+    @property
+    def Count(self) -> int:
+        self.Compact()
+        return self.Source.shape[0]
+
+    def Compact(self):
+        # added tiles are concatenated once instead of on every AddTiles call
+        if len(self.Pending) == 0:
+            return
+        source, y, x, references = zip(*self.Pending)
+        self.Source = np.concatenate((self.Source,) + source)
+        self.Y = np.concatenate((self.Y,) + y)
+        self.X = np.concatenate((self.X,) + x)
+        self.References = np.concatenate((self.References,) + references)
+        self.Split = np.concatenate([self.Split, np.full(sum(s.shape[0] for s in source), UnassignedSplit,
+                                                          dtype=np.uint8)])
+        self.Pending = []
+
+    def IsManifestValid(self) -> bool:
+        return os.path.isfile(os.path.join(self.Path, self.FileName))
+
+    def Open(self):
+        with np.load(os.path.join(self.Path, self.FileName)) as manifest:
+            self.Sources = [str(s) for s in manifest["sources"]]
+            self.SourceIds = {s: i for i, s in enumerate(self.Sources)}
+            # manifests written before the keys were kept cannot tell unchanged sources apart
+            self.Keys = [str(k) for k in manifest["keys"]] if "keys" in manifest else [""] * len(self.Sources)
+            self.Source = manifest["source"]
+            self.Y = manifest["y"]
+            self.X = manifest["x"]
+            self.Split = manifest["split"]
+            if "references" in manifest:
+                self.References = manifest["references"]
+            else:
+                self.References = np.ones(self.Source.shape[0], dtype=np.uint32)
+
+    def Save(self):
+        self.Compact()
+        np.savez(os.path.join(self.Path, self.FileName),
+                 sources=np.asarray(self.Sources, dtype=str), keys=np.asarray(self.Keys, dtype=str),
+                 source=self.Source, y=self.Y, x=self.X, split=self.Split,
+                 references=self.References)
+
+    def AddTiles(self, sourceName: str, windows: np.ndarray, references: np.ndarray, columns: int, step: int,
+                 key: str = ""):
+        # windows are numbered in row-major order, so the offsets follow from the number
+        count = windows.shape[0]
+        if count == 0:
+            return
+        if sourceName not in self.SourceIds:
+            self.SourceIds[sourceName] = len(self.Sources)
+            self.Sources.append(sourceName)
+            self.Keys.append(key)
+        rows, cols = np.divmod(windows.astype(np.int32), columns)
+        self.Pending.append((np.full(count, self.SourceIds[sourceName], dtype=np.int32), rows * step, cols * step,
+                             references.astype(np.uint32)))
+
+    def CarrySplit(self, previous: "TileManifest"):
+        # a re-run must not move held-out tiles into training, so unchanged sources keep the split they had
+        self.Compact()
+        previous.Compact()
+        for sourceId, (name, key) in enumerate(zip(self.Sources, self.Keys)):
+            oldId = previous.SourceIds.get(name)
+            if key == "" or oldId is None or previous.Keys[oldId] != key:
+                continue
+            old = np.flatnonzero(previous.Source == oldId)
+            splits = {(y, x): split for y, x, split in zip(previous.Y[old], previous.X[old], previous.Split[old])}
+            for i in np.flatnonzero(self.Source == sourceId):
+                self.Split[i] = splits.get((self.Y[i], self.X[i]), UnassignedSplit)
+
+    def CreateTestingSet(self, percent: float) -> int:
+        # only tiles without a split get one, they are held out until the testing set reaches the percent
+        self.Compact()
+        unassigned = np.flatnonzero(self.Split == UnassignedSplit)
+        count = int(np.floor(self.Count * percent)) - int(np.count_nonzero(self.Split == TestingSplit))
+        count = min(max(0, count), unassigned.shape[0])
+        self.Split[unassigned] = TrainingSplit
+        self.Split[np.random.choice(unassigned, count, replace=False)] = TestingSplit
+        return count
+
+    def Indices(self, training: bool = True) -> np.ndarray:
+        self.Compact()
+        if training:
+            return np.flatnonzero(self.Split != TestingSplit)
+        return np.flatnonzero(self.Split == TestingSplit)
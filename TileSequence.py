@@ -0,0 +1,34 @@
+import math
+import numpy as np
+from keras.utils import Sequence
+from TileStore import TileStore
+from Tracing import Trace
+
+
+class TileSequence(Sequence):
+    def __init__(self, store: TileStore, indices: np.ndarray, batchSize: int = 32, imageCount: int = 0,
+                 shuffle: bool = True):
+        super(TileSequence, self).__init__()
+        self.Store = store
+        self.BatchSize = batchSize
+        self.Shuffle = shuffle
+        self.Indices = np.array(indices, dtype=np.int64)
+        self.ImageCount = self.Indices.shape[0] if imageCount <= 0 else min(imageCount, self.Indices.shape[0])
+        self.on_epoch_end()
+
+    def __len__(self):
+        return math.ceil(self.ImageCount / self.BatchSize)
+
+    def __getitem__(self, index: int):
+        start = index * self.BatchSize
+        end = min(start + self.BatchSize, self.ImageCount)
+        # the order inside a batch does not matter, sorted indices keep the shard reads local
+        selected = np.sort(self.Indices[start:end])
+        with Trace.Span("batch read", items=selected.shape[0]) as span:
+            rgbImg, normalImg = self.Store.Read(selected)
+            span.Add("bytesRead", rgbImg.nbytes + normalImg.nbytes)
+        return rgbImg, normalImg
+
+    def on_epoch_end(self):
+        if self.Shuffle:
+            np.random.shuffle(self.Indices)
@@ -0,0 +1,124 @@
+import json
+import logging
+import os
+import numpy as np
+
+
+class TileStore:
+    HeaderName = "store.json"
+
+    def __init__(self, path: str, windowSize: int = 0, shardSize: int = 4096, shardPrefix: str = ""):
+        self.Path = path
+        self.ShardPrefix = shardPrefix
+        self.WindowSize = windowSize
+        self.ShardSize = shardSize
+        self.Shards = []  # [name, tile count] pairs in store order
+        self.Count = 0
+
+        self.RGBBuffer = None
+        self.NormalBuffer = None
+        self.BufferCount = 0
+        self.MappedShards = {}
+
+    def IsStoreValid(self) -> bool:
+        return os.path.isfile(os.path.join(self.Path, self.HeaderName))
+
+    def Open(self):
+        with open(os.path.join(self.Path, self.HeaderName), "r") as f:
+            header = json.load(f)
+        if self.WindowSize != 0 and header["windowSize"] != self.WindowSize:
+            raise ValueError("The store at " + self.Path + " contains tiles of size " +
+                             str(header["windowSize"]) + ", not " + str(self.WindowSize) + "!")
+        self.WindowSize = header["windowSize"]
+        self.Shards = [list(s) for s in header["shards"]]
+        self.Count = sum(s[1] for s in self.Shards)
+        self.MappedShards = {}
+
+    def Add(self, rgbTiles: np.ndarray, normalTiles: np.ndarray) -> int:
+        if rgbTiles.shape != normalTiles.shape:
+            raise ValueError("RGB and normal tiles do not match! " +
+                             str(rgbTiles.shape) + " vs " + str(normalTiles.shape))
+        if rgbTiles.shape[1:] != (self.WindowSize, self.WindowSize, 3):
+            raise ValueError("Tiles of shape " + str(rgbTiles.shape[1:]) + " cannot be stored in a store of size " +
+                             str(self.WindowSize) + "!")
+
+        count = rgbTiles.shape[0]
+        added = 0
+        while added < count:
+            if self.RGBBuffer is None:
+                shape = (self.ShardSize, self.WindowSize, self.WindowSize, 3)
+                self.RGBBuffer = np.empty(shape, dtype=np.uint8)
+                self.NormalBuffer = np.empty(shape, dtype=np.uint8)
+            take = min(count - added, self.ShardSize - self.BufferCount)
+            self.RGBBuffer[self.BufferCount:self.BufferCount + take] = rgbTiles[added:added + take]
+            self.NormalBuffer[self.BufferCount:self.BufferCount + take] = normalTiles[added:added + take]
+            self.BufferCount += take
+            added += take
+            if self.BufferCount == self.ShardSize:
+                self.WriteShard()
+
+        self.Count += count
+        return count
+
+    def NextShardName(self) -> str:
+        names = set(s[0] for s in self.Shards)
+        index = len(self.Shards)
+        while self.ShardPrefix + str(index).zfill(5) in names:
+            index += 1
+        return self.ShardPrefix + str(index).zfill(5)
+
+    def ShardPath(self, name: str, isNormal: bool) -> str:
+        prefix = "normal_" if isNormal else "rgb_"
+        return os.path.join(self.Path, prefix + name + ".npy")
+
+    def WriteShard(self):
+        if self.BufferCount == 0:
+            return
+        name = self.NextShardName()
+        np.save(self.ShardPath(name, False), self.RGBBuffer[:self.BufferCount])
+        np.save(self.ShardPath(name, True), self.NormalBuffer[:self.BufferCount])
+        logging.debug("Written shard " + name + " with " + str(self.BufferCount) + " tiles")
+        self.Shards.append([name, self.BufferCount])
+        self.BufferCount = 0
+
+    def Flush(self):
+        self.WriteShard()
+        self.RGBBuffer = None
+        self.NormalBuffer = None
+
+    def Extend(self, shards: list):
+        # registers shards written by another writer into the same folder
+        for name, count in shards:
+            self.Shards.append([name, count])
+            self.Count += count
+
+    def WriteHeader(self):
+        header = {"windowSize": self.WindowSize, "count": self.Count, "shards": self.Shards}
+        with open(os.path.join(self.Path, self.HeaderName), "w") as f:
+            json.dump(header, f)
+
+    def GetShard(self, shard: int):
+        if shard not in self.MappedShards:
+            name = self.Shards[shard][0]
+            self.MappedShards[shard] = (np.load(self.ShardPath(name, False), mmap_mode='r'),
+                                        np.load(self.ShardPath(name, True), mmap_mode='r'))
+        return self.MappedShards[shard]
+
+    def Read(self, indices: np.ndarray):
+        indices = np.asarray(indices, dtype=np.int64)
+        if indices.size > 0 and (indices.min() < 0 or indices.max() >= self.Count):
+            raise IndexError("Tile index out of range for a store of " + str(self.Count) + " tiles")
+
+        shape = (indices.shape[0], self.WindowSize, self.WindowSize, 3)
+        rgb = np.empty(shape, dtype=np.uint8)
+        normal = np.empty(shape, dtype=np.uint8)
+
+        ends = np.cumsum([s[1] for s in self.Shards])
+        shardIds = np.searchsorted(ends, indices, side='right')
+        for shard in np.unique(shardIds):
+            mask = shardIds == shard
+            local = indices[mask] - (ends[shard] - self.Shards[shard][1])
+            rgbShard, normalShard = self.GetShard(int(shard))
+            rgb[mask] = rgbShard[local]
+            normal[mask] = normalShard[local]
+        return rgb, normal
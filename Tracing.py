@@ -0,0 +1,97 @@
+import json
+import os
+import threading
+import time
+
+
+class NullSpan:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, excType, excValue, traceback):
+        return False
+
+    def Add(self, key: str, value: int):
+        pass
+
+
+class Span:
+    def __init__(self, tracer: "Tracer", name: str, counts: dict):
+        self.Tracer = tracer
+        self.Name = name
+        self.Counts = counts
+        self.Start = 0.0
+
+    def __enter__(self):
+        self.Start = time.perf_counter()
+        return self
+
+    def __exit__(self, excType, excValue, traceback):
+        self.Tracer.Record(self.Name, self.Start, time.perf_counter(), self.Counts)
+        return False
+
+    def Add(self, key: str, value: int):
+        self.Counts[key] = self.Counts.get(key, 0) + value
+
+
+class Tracer:
+    CountKeys = ["items", "bytesRead", "bytesWritten"]
+
+    def __init__(self):
+        self.Enabled = False
+        self.Events = []
+        self.Lock = threading.Lock()
+        self.Origin = time.perf_counter()
+        self.Null = NullSpan()
+
+    def Enable(self):
+        self.Enabled = True
+        self.Origin = time.perf_counter()
+
+    def Span(self, name: str, **counts):
+        if not self.Enabled:
+            return self.Null
+        return Span(self, name, counts)
+
+    def Record(self, name: str, start: float, end: float, counts: dict = None, tid: int = None):
+        # spans measured in another process pass their own id, perf_counter is the same clock there
+        if not self.Enabled:
+            return
+        with self.Lock:
+            self.Events.append((name, start, end, threading.get_ident() if tid is None else tid, dict(counts or {})))
+
+    def ExportChromeTrace(self, path: str):
+        pid = os.getpid()
+        with self.Lock:
+            events = [{
+                "name": name,
+                "ph": "X",
+                "ts": (start - self.Origin) * 1e6,
+                "dur": (end - start) * 1e6,
+                "pid": pid,
+                "tid": tid,
+                "args": counts
+            } for name, start, end, tid, counts in self.Events]
+        with open(path, "w") as f:
+            json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, f)
+
+    def Summary(self) -> str:
+        stages = {}
+        with self.Lock:
+            for name, start, end, _, counts in self.Events:
+                stage = stages.setdefault(name, [0, 0.0, {}])
+                stage[0] += 1
+                stage[1] += end - start
+                for key, value in counts.items():
+                    stage[2][key] = stage[2].get(key, 0) + value
+
+        lines = ["{0:<24} {1:>7} {2:>11} {3:>11} {4:>12} {5:>12} {6:>12}".format(
+            "stage", "calls", "total s", "mean ms", "items", "MB read", "MB written")]
+        for name, (calls, total, counts) in sorted(stages.items(), key=lambda s: -s[1][1]):
+            lines.append("{0:<24} {1:>7} {2:>11.3f} {3:>11.3f} {4:>12} {5:>12.1f} {6:>12.1f}".format(
+                name, calls, total, total / calls * 1000, counts.get("items", 0),
+                counts.get("bytesRead", 0) / 1e6, counts.get("bytesWritten", 0) / 1e6))
+        return "\n".join(lines)
+
+
+Trace = Tracer()
@@ -0,0 +1,138 @@
+import hashlib
+import numpy as np
+from Tracing import Trace
+
+
+def HashWindows(*windowSets: np.ndarray) -> list:
+    # one digest per window over every given set, so a tile pair is only equal if both images are
+    windowSets = [np.ascontiguousarray(w) for w in windowSets]
+    hashes = []
+    for i in range(windowSets[0].shape[0]):
+        digest = hashlib.blake2b(digest_size=16)
+        for windows in windowSets:
+            digest.update(windows[i].data)
+        hashes.append(digest.digest())
+    return hashes
+
+
+def PredictUnique(predict, windows: np.ndarray):
+    # flat or repeating textures give many identical windows, only the first of each goes to the model
+    first = {}
+    unique = []
+    inverse = np.empty(windows.shape[0], dtype=np.int64)
+    for i, digest in enumerate(HashWindows(windows)):
+        index = first.setdefault(digest, len(unique))
+        if index == len(unique):
+            unique.append(i)
+        inverse[i] = index
+    if len(unique) == windows.shape[0]:
+        return predict(windows), len(unique)
+    return predict(windows[unique])[inverse], len(unique)
+
+
+def WindowOffsets(length: int, windowSize: int, shift: int) -> np.ndarray:
+    if windowSize > length:
+        raise ValueError("The input image is smaller then the used window.")
+    offsets = np.arange(0, length - windowSize + 1, shift)
+    # the last window is aligned to the border so every pixel is covered
+    if offsets[-1] != length - windowSize:
+        offsets = np.append(offsets, length - windowSize)
+    return offsets
+
+
+def WindowWeights(windowSize: int, weighting: str = "uniform") -> np.ndarray:
+    if weighting == "uniform":
+        return np.ones((windowSize, windowSize, 1), dtype=np.float32)
+    if weighting == "feathered":
+        # triangular falloff towards the window border, never zero so border pixels stay defined
+        ramp = np.minimum(np.arange(windowSize) + 1, windowSize - np.arange(windowSize)).astype(np.float32)
+        ramp /= ramp.max()
+        return np.outer(ramp, ramp)[:, :, np.newaxis]
+    raise ValueError("Unknown window weighting: " + str(weighting))
+
+
+def QuantizeImage(image: np.ndarray) -> np.ndarray:
+    # the network output is in [0, 1], it is brought back to uint8 once per image
+    image = image * 255
+    np.round(image, out=image)
+    np.clip(image, 0, 255, out=image)
+    return image.astype(np.uint8)
+
+
+def PadRows(image: np.ndarray, start: int, end: int, alignment: int) -> np.ndarray:
+    # rows of the image as if it had been reflection padded to the alignment, only this range is copied
+    height = image.shape[0]
+    rows = np.arange(start, end)
+    rows = np.where(rows < height, rows, 2 * (height - 1) - rows)
+    strip = image[rows] if end > height else image[start:end]
+    padWidth = (-image.shape[1]) % alignment
+    if padWidth != 0:
+        strip = np.pad(strip, ((0, 0), (0, padWidth), (0, 0)), mode='reflect')
+    return strip
+
+
+def PredictStrips(forward, image: np.ndarray, stripHeight: int, alignment: int = 4, halo: int = 32):
+    height, width = image.shape[0], image.shape[1]
+    # the pooling needs sizes divisible by its factor to give back the input size
+    paddedHeight = height + (-height) % alignment
+    if stripHeight <= 0 or stripHeight >= paddedHeight:
+        yield 0, height, forward(PadRows(image, 0, paddedHeight, alignment)[np.newaxis])[0, :height, :width, :]
+        return
+
+    # strips start on the pooling grid, so they see the same pooled values as a full pass
+    stripHeight = max(alignment, stripHeight - stripHeight % alignment)
+    for start in range(0, height, stripHeight):
+        end = min(start + stripHeight, paddedHeight)
+        contextStart = max(0, start - halo)
+        contextEnd = min(paddedHeight, end + halo)
+        strip = forward(PadRows(image, contextStart, contextEnd, alignment)[np.newaxis])
+        end = min(end, height)
+        yield start, end, strip[0, start - contextStart:end - contextStart, :width, :]
+
+
+def PredictFullImage(forward, image: np.ndarray, stripHeight: int = 0, alignment: int = 4,
+                     halo: int = 32) -> np.ndarray:
+    result = np.empty((image.shape[0], image.shape[1], 3), dtype=np.float32)
+    for start, end, strip in PredictStrips(forward, image, stripHeight, alignment, halo):
+        result[start:end] = strip
+    return result
+
+
+class WindowedPredictor:
+    def __init__(self, predict, windowSize: int, batchSize: int = 256, weighting: str = "feathered"):
+        self.PredictBatch = predict
+        self.WindowSize = windowSize
+        self.BatchSize = batchSize
+        self.Weights = WindowWeights(windowSize, weighting)
+        self.WindowCount = 0
+        self.PredictedCount = 0
+
+    def Predict(self, image: np.ndarray, shift: int) -> np.ndarray:
+        size = self.WindowSize
+        rowOffsets = WindowOffsets(image.shape[0], size, shift)
+        colOffsets = WindowOffsets(image.shape[1], size, shift)
+        # (rows, cols, channels, size, size) view, windows are only copied into the batch buffer
+        view = np.lib.stride_tricks.sliding_window_view(image, (size, size), axis=(0, 1))
+
+        sums = np.zeros((image.shape[0], image.shape[1], 3), dtype=np.float32)
+        weights = np.zeros((image.shape[0], image.shape[1], 1), dtype=np.float32)
+        batch = np.empty((self.BatchSize, size, size, image.shape[2]), dtype=image.dtype)
+
+        total = rowOffsets.shape[0] * colOffsets.shape[0]
+        for start in range(0, total, self.BatchSize):
+            count = min(self.BatchSize, total - start)
+            rows, cols = np.divmod(np.arange(start, start + count), colOffsets.shape[0])
+            ys = rowOffsets[rows]
+            xs = colOffsets[cols]
+            batch[:count] = view[ys, xs].transpose((0, 2, 3, 1))
+
+            predicted, predictedCount = PredictUnique(self.PredictBatch, batch[:count])
+            self.WindowCount += count
+            self.PredictedCount += predictedCount
+            with Trace.Span("stitching", items=count):
+                for i in range(count):
+                    sums[ys[i]:ys[i] + size, xs[i]:xs[i] + size] += predicted[i] * self.Weights
+                    weights[ys[i]:ys[i] + size, xs[i]:xs[i] + size] += self.Weights
+
+        sums /= weights
+        return sums
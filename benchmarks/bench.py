@@ -0,0 +1,259 @@
+import argparse
+import json
+import os
+import platform
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+import cv2
+import numpy as np
+
+RepositoryDirectory = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, RepositoryDirectory)
+
+from ImageProcessor import ImageProcessor, SplitImage
+from Dataset import Dataset
+from ImageBuilder import ImageBuilder
+from NumpyNetwork import NumpyNetwork
+
+WindowSizes = [16, 32, 64, 128, 256]
+Shifts = [8, 16, 32, 64]
+
+
+def StepSize(windowSize: int) -> int:
+    # same steps as the demo cycle in main.py
+    if windowSize <= 64:
+        return windowSize
+    return 32 if windowSize == 128 else 16
+
+
+def SyntheticPair(rng: np.random.Generator, size: int):
+    # smooth height field, so the normal map is consistent with the RGB image
+    coarse = rng.random((size // 16, size // 16)).astype(np.float32)
+    height = cv2.resize(coarse, (size, size), interpolation=cv2.INTER_CUBIC)
+    rgb = np.clip(np.stack([height, height * 0.8, height * 0.6], axis=2) * 255, 0, 255).astype(np.uint8)
+    dy, dx = np.gradient(height * 8)
+    normal = np.stack([-dx, -dy, np.ones_like(height)], axis=2)
+    normal /= np.linalg.norm(normal, axis=2, keepdims=True)
+    normal = ((normal * 0.5 + 0.5) * 255).astype(np.uint8)[:, :, ::-1]
+    return rgb, normal
+
+
+def RandomNumpyNetwork(workDir: str, windowSize: int, rng: np.random.Generator) -> NumpyNetwork:
+    channels = [(3, 15), (15, 30), (30, 15), (15, 3)]
+    weights = {"count": len(channels)}
+    for i, (cin, cout) in enumerate(channels):
+        weights["kernel_" + str(i)] = (rng.standard_normal((3, 3, cin, cout)) * 0.1).astype(np.float32)
+        weights["bias_" + str(i)] = np.zeros(cout, dtype=np.float32)
+    network = NumpyNetwork(workDir, windowSize)
+    np.savez(network.WeightPath, **weights)
+    network.LoadModel()
+    return network
+
+
+def KerasNetwork(workDir: str, windowSize: int):
+    try:
+        from Network import NormalGeneratorNetwork
+    except ImportError:
+        return None
+    network = NormalGeneratorNetwork(workDir, windowSize)
+    network.CreateModel()
+    return network
+
+
+def Measure(results: dict, name: str, func, items: int, repeat: int, setup=None):
+    times = []
+    for _ in range(repeat):
+        if setup is not None:
+            setup()
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+    seconds = statistics.median(times)
+    results[name] = {"seconds": seconds, "items": items, "rate": items / seconds if seconds > 0 else 0.0}
+    print("{0:<40} {1:>10.4f}s {2:>14.1f}/s".format(name, seconds, results[name]["rate"]))
+
+
+def Run(args) -> dict:
+    rng = np.random.default_rng(args.seed)
+    results = {}
+    workDir = tempfile.mkdtemp(prefix="normal_bench_")
+    os.chdir(workDir)
+    try:
+        return RunIn(args, rng, results)
+    finally:
+        os.chdir(tempfile.gettempdir())
+        shutil.rmtree(workDir, ignore_errors=True)
+
+
+def RunIn(args, rng: np.random.Generator, results: dict) -> dict:
+    os.mkdir("rgb")
+    os.mkdir("normal")
+    for i in range(args.images):
+        rgb, normal = SyntheticPair(rng, args.image_size)
+        cv2.imwrite(os.path.join("rgb", str(i).zfill(3) + ".png"), rgb)
+        cv2.imwrite(os.path.join("normal", str(i).zfill(3) + ".png"), normal)
+    image, _ = SyntheticPair(rng, args.image_size)
+
+    for windowSize in args.sizes:
+        step = StepSize(windowSize)
+        windows = ((args.image_size - windowSize) // step + 1) ** 2
+        Measure(results, "split/{0}".format(windowSize),
+                lambda: SplitImage(image, step, windowSize), windows, args.repeat)
+
+        processor = ImageProcessor("rgb", "normal", "work", 0)
+        Measure(results, "process/{0}".format(windowSize),
+                lambda: processor.ProcessImages(windowSize, step, True, args.workers),
+                windows * args.images, args.repeat)
+        processor.CreateTestingSet()
+
+        dataset = Dataset("work", args.load_count, False, True, imageSize=windowSize)
+        Measure(results, "load/{0}".format(windowSize), dataset.Load, args.load_count, args.repeat)
+
+        networks = [("numpy", RandomNumpyNetwork("work", windowSize, rng))]
+        kerasNetwork = KerasNetwork("work", windowSize)
+        if kerasNetwork is not None:
+            networks.append(("keras", kerasNetwork))
+        batch = rng.integers(0, 256, (args.batch, windowSize, windowSize, 3), dtype=np.uint8)
+        for runtime, network in networks:
+            Measure(results, "predict/{0}/{1}".format(runtime, windowSize),
+                    lambda: network.Predict(batch, False, args.batch), args.batch, args.repeat)
+
+            builder = ImageBuilder("work", network, windowSize)
+            builder.InputImage = image
+            tiles = (args.image_size // windowSize) ** 2
+
+            def BuildTiled():
+                parts = SplitImage(builder.InputImage, windowSize, windowSize)
+                builder.BuildTiledImage(builder.PredictParts(parts))
+
+            Measure(results, "build_tiled/{0}/{1}".format(runtime, windowSize), BuildTiled, tiles, args.repeat)
+            for shift in Shifts:
+                if shift >= windowSize:
+                    continue
+                count = ((args.image_size - windowSize) // shift + 1) ** 2
+                Measure(results, "build_shifted/{0}/{1}/{2}".format(runtime, windowSize, shift),
+                        lambda: builder.BuildShiftedImage(shift), count, args.repeat)
+
+    pyramid = [(windowSize, StepSize(windowSize)) for windowSize in args.sizes]
+    windows = sum(((args.image_size - w) // s + 1) ** 2 for w, s in pyramid) * args.images
+    processor = ImageProcessor("rgb", "normal", "work", 0)
+    Measure(results, "process_pyramid", lambda: processor.ProcessPyramid(pyramid, True, args.workers),
+            windows, args.repeat)
+
+    return {
+        "meta": {
+            "python": platform.python_version(),
+            "numpy": np.__version__,
+            "platform": platform.platform(),
+            "cpus": os.cpu_count(),
+            "arguments": {k: v for k, v in vars(args).items() if k not in ("func", "output")}
+        },
+        "results": results
+    }
+
+
+def RunCommand(args):
+    output = os.path.abspath(args.output)
+    cwd = os.getcwd()
+    try:
+        report = Run(args)
+    finally:
+        os.chdir(cwd)
+    with open(output, "w") as f:
+        json.dump(report, f, indent=2)
+    print("Results written to " + output)
+
+
+def Scaling(args):
+    # trains on random crops of synthetic sources, so no tiles have to be prepared for the runs
+    rng = np.random.default_rng(args.seed)
+    workDir = tempfile.mkdtemp(prefix="normal_scaling_")
+    try:
+        for folder in ("rgb", "normal", "work", os.path.join("work", "result_" + str(args.size))):
+            os.mkdir(os.path.join(workDir, folder))
+        for i in range(args.images):
+            rgb, normal = SyntheticPair(rng, args.image_size)
+            cv2.imwrite(os.path.join(workDir, "rgb", str(i).zfill(3) + ".png"), rgb)
+            cv2.imwrite(os.path.join(workDir, "normal", str(i).zfill(3) + ".png"), normal)
+        # main.py only accepts a log file that already exists
+        open(os.path.join(workDir, "log.txt"), "w").close()
+
+        print("{0:>8} {1:>14} {2:>10}".format("workers", "samples/s", "speedup"))
+        baseline = None
+        for workers in args.workers:
+            report = os.path.join(workDir, "report_" + str(workers) + ".json")
+            subprocess.run([sys.executable, os.path.join(RepositoryDirectory, "main.py"), "-w", "work", "-l", "log.txt",
+                            "train", "--crops", "-s", str(args.size), "-e", str(args.epochs), "-c", str(args.count),
+                            "-j", str(workers), "--report", report], cwd=workDir, check=True)
+            with open(report) as f:
+                rates = json.load(f)["samplesPerSecond"]
+            # the first epoch includes the graph tracing and the cluster setup
+            rate = statistics.median(rates[1:] if len(rates) > 1 else rates)
+            baseline = rate if baseline is None else baseline
+            print("{0:>8} {1:>14.1f} {2:>9.2f}x".format(workers, rate, rate / baseline))
+    finally:
+        shutil.rmtree(workDir, ignore_errors=True)
+
+
+def Compare(args) -> int:
+    with open(args.baseline) as f:
+        baseline = json.load(f)["results"]
+    with open(args.current) as f:
+        current = json.load(f)["results"]
+
+    regressions = 0
+    for name in sorted(set(baseline) & set(current)):
+        change = current[name]["seconds"] / baseline[name]["seconds"] - 1
+        flag = ""
+        if change > args.threshold:
+            flag = "REGRESSION"
+            regressions += 1
+        elif change < -args.threshold:
+            flag = "improved"
+        print("{0:<40} {1:>10.4f}s {2:>10.4f}s {3:>+8.1%} {4}".format(
+            name, baseline[name]["seconds"], current[name]["seconds"], change, flag))
+    for name in sorted(set(baseline) ^ set(current)):
+        print("{0:<40} only in {1}".format(name, "baseline" if name in baseline else "current"))
+    print("{0} regression(s) over {1:.0%}".format(regressions, args.threshold))
+    return 1 if regressions > 0 else 0
+
+
+parser = argparse.ArgumentParser(description="Benchmarks for the tiling, loading and inference hot paths")
+commands = parser.add_subparsers(dest="command", required=True)
+
+runParser = commands.add_parser("run", help="Run the benchmarks on synthetic data")
+runParser.add_argument("-o", "--output", type=str, default="bench_results.json", help="The JSON file to write")
+runParser.add_argument("--sizes", type=int, nargs="+", default=WindowSizes, help="The window sizes to benchmark")
+runParser.add_argument("--images", type=int, default=4, help="The number of synthetic source pairs")
+runParser.add_argument("--image_size", type=int, default=512, help="The size of the synthetic images")
+runParser.add_argument("--load_count", type=int, default=1000, help="The number of tiles loaded by the dataset")
+runParser.add_argument("--batch", type=int, default=64, help="The batch size used for prediction")
+runParser.add_argument("--workers", type=int, default=1, help="The number of tiling processes")
+runParser.add_argument("--repeat", type=int, default=3, help="The number of runs, the median is reported")
+runParser.add_argument("--seed", type=int, default=0, help="The seed of the synthetic data")
+runParser.set_defaults(func=RunCommand)
+
+scalingParser = commands.add_parser("scaling", help="Measure the training throughput with several local workers")
+scalingParser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4], help="The worker counts to measure")
+scalingParser.add_argument("--size", type=int, default=64, help="The window size of the trained network")
+scalingParser.add_argument("--epochs", type=int, default=3, help="The number of epochs per run")
+scalingParser.add_argument("--count", type=int, default=4096, help="The number of crops per epoch")
+scalingParser.add_argument("--images", type=int, default=8, help="The number of synthetic source pairs")
+scalingParser.add_argument("--image_size", type=int, default=512, help="The size of the synthetic images")
+scalingParser.add_argument("--seed", type=int, default=0, help="The seed of the synthetic data")
+scalingParser.set_defaults(func=Scaling)
+
+compareParser = commands.add_parser("compare", help="Compare a result file against a baseline")
+compareParser.add_argument("baseline", type=str, help="The baseline JSON file")
+compareParser.add_argument("current", type=str, help="The JSON file to check")
+compareParser.add_argument("--threshold", type=float, default=0.1, help="The relative slowdown counted as a regression")
+compareParser.set_defaults(func=Compare)
+
+if __name__ == "__main__":
+    arguments = parser.parse_args()
+    sys.exit(arguments.func(arguments) or 0)
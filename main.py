@@ -1,10 +1,13 @@
-from ImageProcessor import ImageProcessor
-from Dataset import Dataset
-from Network import NormalGeneratorNetwork
-from ImageBuilder import ImageBuilder
 import logging
 import argparse
+import json
 import os.path
+import socket
+import subprocess
+import sys
+import time
+from Tracing import Trace
+from MemoryBudget import Memory
 
 def file_path(string):
     if os.path.isfile(string) or string is None:
@@ -18,52 +21,329 @@ def dir_path(string):
     else:
         raise NotADirectoryError(string)
 
-def DemoCycle(workdir: str, rgbDir: str, normalDir: str, maxImageCount: int):
+def DefaultStepSize(imageSize: int) -> int:
+    if imageSize == 16 or imageSize == 32:
+        return imageSize
+    elif imageSize == 64:
+        return 64
+    elif imageSize == 128:
+        return 32
+    else:
+        return 16
+
+def LoadGenerator(workdir: str, size: int, useNumpy: bool = False, quantized: str = None):
+    if quantized is not None:
+        from TFLiteNetwork import TFLiteNetwork
+        generatorNetwork = TFLiteNetwork(workdir, size, quantized)
+    elif useNumpy:
+        from NumpyNetwork import NumpyNetwork
+        generatorNetwork = NumpyNetwork(workdir, size)
+    else:
+        from Network import NormalGeneratorNetwork
+        generatorNetwork = NormalGeneratorNetwork(workdir, size)
+    if not generatorNetwork.IsModelExists():
+        logging.error("No model of {0} size exists!".format(size))
+        exit(1)
+    generatorNetwork.LoadModel()
+    return generatorNetwork
+
+def DemoCycle(workdir: str, rgbDir: str, normalDir: str, maxImageCount: int, workers: int = 1):
+    from ImageProcessor import ImageProcessor
+
     imageSizes = [16, 32, 64, 128, 256]
 
+    # every source is decoded once and tiled for all the sizes before the first round starts
+    processor = ImageProcessor(rgbDir, normalDir, workdir, maxImageCount)
+    processor.ProcessPyramid([(imageSize, DefaultStepSize(imageSize)) for imageSize in imageSizes], workers=workers)
+    processor.CreateTestingSet()
+    processor = None
+
+    summaries = {}
     for imageSize in imageSizes:
-        logging.info("Starting new round with image size " + str(imageSize))
-        processor = ImageProcessor(rgbDir, normalDir, workdir, maxImageCount)
-        if imageSize == 16 or imageSize == 32:
-            stepSize = imageSize
-        elif imageSize == 64:
-            stepSize = 64
-        elif imageSize == 128:
-            stepSize = 32
-        else:
-            stepSize = 16
-        processor.ProcessImages(imageSize, stepSize)
-        processor.CreateTestingSet()
+        with Trace.Span("round " + str(imageSize)), Memory.Stage("round " + str(imageSize)):
+            summaries[str(imageSize)] = DemoRound(workdir, imageSize)
+
+    # epochs and time to the target loss of every size, to compare the training cost between runs
+    with open(os.path.join(workdir, "training_summary.json"), "w") as f:
+        json.dump(summaries, f, indent=2)
+    for imageSize, summary in summaries.items():
+        logging.info("Size {0}: {1} epochs in {2:.1f}s, best loss {3}".format(
+            imageSize, summary["epochs"], summary["seconds"], summary["bestLoss"]))
+
+def DemoRound(workdir: str, imageSize: int) -> dict:
+    from Dataset import Dataset
+    from Network import NormalGeneratorNetwork
+    from ImageBuilder import ImageBuilder
+
+    logging.info("Starting new round with image size " + str(imageSize))
+    trainingDataset = Dataset(workdir, 0, True, True, streaming=True, imageSize=imageSize)
+    testingDataset = Dataset(workdir, 0, True, False, streaming=True, imageSize=imageSize)
+
+    network = NormalGeneratorNetwork(workdir, imageSize, trainingDataset, testingDataset)
+    network.CreateModel()
+    network.Train()
+    #network.LoadModel()
+
+
+    trainingDataset = None
+    testingDataset = None
+
+    builder = ImageBuilder(workdir, network, imageSize)
+    builder.GenerateImage()
+    builder = None
+    logging.info("Round finished!")
+    return network.TrainingSummary
+
+def Prepare(args):
+    from ImageProcessor import ImageProcessor
+
+    sizes = [(size, args.step if args.step > 0 else DefaultStepSize(size)) for size in args.size]
+    processor = ImageProcessor(args.rgb, args.normal, args.workdir, args.max_images)
+    processor.ProcessPyramid(sizes, args.rebuild, args.workers)
+    for size, _ in sizes:
+        processor.CreateTestingSet(args.test_split, size)
+
+def FreePorts(count: int) -> list:
+    sockets = [socket.socket() for _ in range(count)]
+    for s in sockets:
+        s.bind(("localhost", 0))
+    ports = [s.getsockname()[1] for s in sockets]
+    for s in sockets:
+        s.close()
+    return ports
+
+def LaunchWorkers(count: int) -> int:
+    # the same command runs in every worker, the TF_CONFIG tells it its place in the cluster
+    cluster = {"worker": ["localhost:" + str(port) for port in FreePorts(count)]}
+    processes = []
+    for index in range(count):
+        config = {"cluster": cluster, "task": {"type": "worker", "index": index}}
+        env = dict(os.environ, TF_CONFIG=json.dumps(config))
+        processes.append(subprocess.Popen([sys.executable] + sys.argv, env=env))
+    # a worker that dies leaves the others waiting in the collectives forever, so they are stopped with it
+    while True:
+        codes = [p.poll() for p in processes]
+        failed = [code for code in codes if code is not None and code != 0]
+        if len(failed) > 0:
+            logging.error("A training worker exited with {0}, stopping the others".format(failed[0]))
+            for p in processes:
+                if p.poll() is None:
+                    p.terminate()
+            for p in processes:
+                p.wait()
+            return failed[0]
+        if all(code is not None for code in codes):
+            return 0
+        time.sleep(0.5)
+
+def Train(args):
+    if args.workers > 1 and "TF_CONFIG" not in os.environ:
+        logging.info("Starting {0} training workers".format(args.workers))
+        exit(LaunchWorkers(args.workers))
+
+    import tensorflow as tf
+    from Network import NormalGeneratorNetwork, CreateStrategy, IsChief
+
+    if args.workers > 1:
+        # the workers share the cores of the machine instead of each using all of them
+        tf.config.threading.set_intra_op_parallelism_threads(max(1, (os.cpu_count() or 1) // args.workers))
+    strategy = CreateStrategy()
+
+    if args.crops:
+        # crops are cut from the decoded sources for every batch, no tiles have to be prepared
+        from CropSampler import CropSampler
+        count = args.count if args.count > 0 else 10000
+        trainingDataset = CropSampler(args.rgb, args.normal, args.size, count, True, args.test_split,
+                                      not args.no_augment, not args.green_down)
+        testingDataset = CropSampler(args.rgb, args.normal, args.size, max(1, int(count * args.test_split)), False,
+                                     args.test_split, greenUp=not args.green_down)
+    else:
+        from Dataset import Dataset
+        trainingDataset = Dataset(args.workdir, args.count, True, True, streaming=True, imageSize=args.size)
+        testingDataset = Dataset(args.workdir, 0, True, False, streaming=True, imageSize=args.size)
+    network = NormalGeneratorNetwork(args.workdir, args.size, trainingDataset, testingDataset)
+    network.TrainingEpochs = args.epochs
+    network.StoppingPatience = args.patience
+    network.TargetLoss = args.target_loss
+    network.Strategy = strategy
+    network.Train()
 
-        trainingDataset = Dataset(workdir, 1000, True, True)
-        testingDataset = Dataset(workdir, 100, True, False)
+    if args.report is not None and IsChief(strategy):
+        report = {"workers": network.ReplicaCount(), "globalBatchSize": network.BatchSize * network.ReplicaCount(),
+                  "samplesPerSecond": network.SamplesPerSecond, "training": network.TrainingSummary}
+        with open(args.report, "w") as f:
+            json.dump(report, f, indent=2)
 
-        network = NormalGeneratorNetwork(workdir, imageSize, trainingDataset, testingDataset)
-        network.CreateModel()
-        network.Train()
-        #network.LoadModel()
+def Generate(args):
+    from ImageBuilder import ImageBuilder
 
+    if args.file is None and args.input is None:
+        logging.error("Either a file or an input directory is needed for generation!")
+        exit(1)
+    imgBuilder = ImageBuilder(args.workdir, LoadGenerator(args.workdir, args.size, args.numpy, args.quantized), args.size)
+    imgBuilder.StripHeight = args.strip_height
+    if args.cache is not None:
+        from ResultCache import ResultCache
+        imgBuilder.Cache = ResultCache(args.cache, args.cache_size * 1024 * 1024)
+    if args.input is not None:
+        from BatchBuilder import BatchBuilder, CollectInputs
+        batchBuilder = BatchBuilder(imgBuilder, args.threads)
+        batchBuilder.Build(CollectInputs(args.input), args.output)
+    else:
+        imgBuilder.BuildSinglePicture(args.file)
+    if imgBuilder.Cache is not None:
+        stats = imgBuilder.Cache.Stats()
+        logging.info("Result cache: " + json.dumps(stats))
+        print("Result cache: {0} hits, {1} misses, {2} entries, {3:.1f} MB".format(
+            stats["hits"], stats["misses"], stats["entries"], stats["bytes"] / (1024 * 1024)))
+    if args.input is not None and batchBuilder.Failed > 0:
+        exit(1)
+
+def Export(args):
+    from NumpyNetwork import NumpyNetwork
+
+    generatorNetwork = LoadGenerator(args.workdir, args.size)
+    generatorNetwork.ExportFoldedWeights()
+    difference = generatorNetwork.CheckParity(NumpyNetwork(args.workdir, args.size))
+    print("Largest difference between the Keras and NumPy outputs: {0}".format(difference))
+
+def Quantize(args):
+    from Dataset import Dataset
+    from TFLiteNetwork import TFLiteNetwork, ExportQuantized, CompareQuantized
+
+    generatorNetwork = LoadGenerator(args.workdir, args.size)
+    # the calibration and the comparison use held-out tiles, never ones the model was trained on
+    testing = Dataset(args.workdir, args.calibration + args.samples, True, False, imageSize=args.size)
+    calibration = testing.Dataset[0][:args.calibration]
+    samples = testing.Dataset[0][args.calibration:]
+
+    variants = []
+    for mode in args.modes:
+        ExportQuantized(generatorNetwork, mode, calibration)
+        variant = TFLiteNetwork(args.workdir, args.size, mode)
+        variant.LoadModel()
+        variants.append(variant)
+
+    rows = CompareQuantized(generatorNetwork, variants, samples)
+    print("{0:<10} {1:>10} {2:>14} {3:>18}".format("mode", "size (KB)", "windows/s", "angular error (deg)"))
+    for row in rows:
+        print("{0:<10} {1:>10.1f} {2:>14.1f} {3:>18.3f}".format(
+            row["mode"], row["bytes"] / 1024, row["windowsPerSecond"], row["angularError"]))
+    logging.info("Quantized variants: " + json.dumps(rows))
+
+def Evaluate(args):
+    from Evaluation import Evaluation
+
+    evaluation = Evaluation(args.workdir, args.rgb, args.normal, args.sizes, args.shifts, args.numpy, args.count,
+                            args.max_height)
+    rows = evaluation.Run()
+    print("{0:>5} {1:<8} {2:>5} {3:>10} {4:>10} {5:>6} {6:>10} {7:>12} {8:>8} {9}".format(
+        "size", "mode", "shift", "error", "mse", "seams", "latency", "windows/s", "s/MP", "pareto"))
+    for row in sorted(rows, key=lambda r: r["secondsPerMegapixel"]):
+        print("{0:>5} {1:<8} {2:>5} {3:>10.3f} {4:>10.5f} {5:>6.2f} {6:>9.3f}s {7:>12.1f} {8:>8.3f} {9}".format(
+            row["size"], row["mode"], row["shift"], row["angularError"], row["mse"], row["seamScore"],
+            row["latency"], row["windowsPerSecond"], row["secondsPerMegapixel"], "*" if row["pareto"] else ""))
+    with open(args.output, "w") as f:
+        json.dump(rows, f, indent=2)
+
+def Serve(args):
+    from InferenceServer import InferenceServer
 
-        processor = None
-        trainingDataset = None
-        testingDataset = None
+    sizes = args.sizes if args.sizes is not None else [args.size]
+    try:
+        server = InferenceServer(args.workdir, sizes, args.max_batch, args.max_delay / 1000)
+    except ValueError as e:
+        logging.error(e)
+        exit(1)
+    server.Serve(port=args.port)
 
-        builder = ImageBuilder(workdir, network, imageSize)
-        builder.GenerateImage()
-        builder = None
-        logging.info("Round finished!")
+def Demo(args):
+    DemoCycle(args.workdir, args.rgb, args.normal, args.max_images, args.workers)
 
 
 
 parser = argparse.ArgumentParser(description="A neural network for normal map generation")
-parser.add_argument("-s", "--size", type=int, default=64, help="The window size to use on the network")
-parser.add_argument("-f", "--file", type=file_path, default=None, help="The path of the diffuse map to generate normal map from")
-parser.add_argument("-d", "--demo", action="store_true", help="Set this to run the demo cycle")
 parser.add_argument("-w", "--workdir", type=dir_path, default="work", help="Set the working directory for the project")
-parser.add_argument("-r", "--rgb", type=dir_path, default="rgb", help="Set the path to the RGB files")
-parser.add_argument("-n", "--normal", type=dir_path, default="normal", help="Set the path to the normal maps")
 parser.add_argument("-l", "--log", type=file_path, default="log.txt", help="The path to the logfile")
-parser.add_argument("-m", "--max_images", type=int, default=10000, help="The maximum amount of training images to create")
+parser.add_argument("--trace", type=str, default=None, help="Record stage timings and write them as a Chrome trace to this path")
+parser.add_argument("--memory_budget", type=int, default=0, help="The memory in MB the dataset, batches and strips are sized to fit (0 sets no budget)")
+commands = parser.add_subparsers(dest="command", required=True)
+
+prepareParser = commands.add_parser("prepare", help="Tile the source images into the training and testing sets")
+prepareParser.add_argument("-s", "--size", type=int, nargs="+", default=[64], help="The window sizes of the tiles, every source is decoded once for all of them")
+prepareParser.add_argument("--step", type=int, default=0, help="The step between two tiles (0 picks the demo step for the size)")
+prepareParser.add_argument("--rebuild", action="store_true", help="Delete every existing tile instead of only re-tiling changed sources")
+prepareParser.add_argument("--test_split", type=float, default=0.2, help="The part of the tiles moved to the testing set")
+prepareParser.set_defaults(func=Prepare)
+
+trainParser = commands.add_parser("train", help="Train the network on the prepared tiles")
+trainParser.add_argument("-s", "--size", type=int, default=64, help="The window size to use on the network")
+trainParser.add_argument("-e", "--epochs", type=int, default=100, help="The maximum number of training epochs, an interrupted run resumes where it stopped")
+trainParser.add_argument("--patience", type=int, default=10, help="Stop after this many epochs without a better validation loss")
+trainParser.add_argument("--target_loss", type=float, default=0.0, help="Log the epochs and time needed to reach this validation loss")
+trainParser.add_argument("-c", "--count", type=int, default=0, help="The number of tiles used per epoch (0 uses every tile, or 10000 crops)")
+trainParser.add_argument("--crops", action="store_true", help="Train on random crops of the source images instead of the prepared tiles")
+trainParser.add_argument("-r", "--rgb", type=dir_path, default="rgb", help="Set the path to the RGB files used for the crops")
+trainParser.add_argument("-n", "--normal", type=dir_path, default="normal", help="Set the path to the normal maps used for the crops")
+trainParser.add_argument("--test_split", type=float, default=0.2, help="The part of the sources held out for testing the crops")
+trainParser.add_argument("--no_augment", action="store_true", help="Do not flip and rotate the training crops")
+trainParser.add_argument("--green_down", action="store_true", help="The normal maps have their green channel pointing down (DirectX convention)")
+trainParser.add_argument("-j", "--workers", type=int, default=1, help="The number of local data-parallel training processes")
+trainParser.add_argument("--report", type=str, default=None, help="Write the training throughput of every epoch as JSON to this path")
+trainParser.set_defaults(func=Train)
+
+generateParser = commands.add_parser("generate", help="Generate normal maps from diffuse maps")
+generateParser.add_argument("-s", "--size", type=int, default=64, help="The window size to use on the network")
+generateParser.add_argument("-f", "--file", type=file_path, default=None, help="The path of the diffuse map to generate normal map from")
+generateParser.add_argument("-i", "--input", type=str, default=None, help="A directory or glob of diffuse maps to generate normal maps from")
+generateParser.add_argument("-o", "--output", type=str, default="generated", help="The directory to write the generated normal maps to")
+generateParser.add_argument("-t", "--threads", type=int, default=4, help="The number of threads used for decoding and encoding images")
+generateParser.add_argument("--strip_height", type=int, default=0, help="Predict the image in strips of this height (0 streams a single file in strips of 256 rows and predicts batch inputs at once)")
+generateParser.add_argument("--numpy", action="store_true", help="Generate with the exported NumPy runtime instead of TensorFlow")
+generateParser.add_argument("--quantized", type=str, default=None, choices=["dynamic", "int8", "float16"], help="Generate with a quantized TFLite variant of the model")
+generateParser.add_argument("--cache", type=str, default=None, help="A directory caching the generated maps by input pixels, weights and settings")
+generateParser.add_argument("--cache_size", type=int, default=1024, help="The size limit of the result cache in MB, the least recently used maps are evicted")
+generateParser.set_defaults(func=Generate)
+
+exportParser = commands.add_parser("export", help="Export the model with folded batch-norms for the NumPy runtime")
+exportParser.add_argument("-s", "--size", type=int, default=64, help="The window size of the exported model")
+exportParser.set_defaults(func=Export)
+
+quantizeParser = commands.add_parser("quantize", help="Export quantized TFLite variants and compare them with the float model")
+quantizeParser.add_argument("-s", "--size", type=int, default=64, help="The window size of the quantized model")
+quantizeParser.add_argument("--modes", type=str, nargs="+", default=["dynamic", "int8", "float16"], choices=["dynamic", "int8", "float16"], help="The quantized variants to export")
+quantizeParser.add_argument("--calibration", type=int, default=256, help="The number of testing tiles used to calibrate the int8 model")
+quantizeParser.add_argument("--samples", type=int, default=256, help="The number of testing tiles used for the comparison")
+quantizeParser.set_defaults(func=Quantize)
+
+evaluateParser = commands.add_parser("evaluate", help="Measure quality and cost of every model size and shift on held-out textures")
+# there is no default, the sources of prepare and train would score the models on their own training textures
+evaluateParser.add_argument("-r", "--rgb", type=dir_path, required=True, help="The held-out diffuse maps, none of them used for training")
+evaluateParser.add_argument("-n", "--normal", type=dir_path, required=True, help="The normal maps of the held-out diffuse maps")
+evaluateParser.add_argument("--sizes", type=int, nargs="+", default=[16, 32, 64, 128, 256], help="The model sizes to evaluate")
+evaluateParser.add_argument("--shifts", type=int, nargs="+", default=[8, 16, 32, 64], help="The window shifts to evaluate")
+evaluateParser.add_argument("-c", "--count", type=int, default=0, help="The number of textures to evaluate on (0 uses every one)")
+evaluateParser.add_argument("--max_height", type=int, default=1024, help="Halve textures taller than this before the evaluation (0 keeps them)")
+evaluateParser.add_argument("--numpy", action="store_true", help="Evaluate the exported NumPy runtime instead of TensorFlow")
+evaluateParser.add_argument("-o", "--output", type=str, default="evaluation.json", help="The JSON file to write the table to")
+evaluateParser.set_defaults(func=Evaluate)
+
+serveParser = commands.add_parser("serve", help="Run a local inference server")
+serveParser.add_argument("-s", "--size", type=int, default=64, help="The window size to use on the network")
+serveParser.add_argument("--sizes", type=int, nargs="+", default=None, help="The model sizes the server keeps loaded (defaults to --size)")
+serveParser.add_argument("--port", type=int, default=8765, help="The port of the inference server")
+serveParser.add_argument("--max_batch", type=int, default=256, help="The maximum number of windows in a server batch")
+serveParser.add_argument("--max_delay", type=float, default=5, help="The maximum time in ms a window waits for its batch to fill")
+serveParser.set_defaults(func=Serve)
+
+demoParser = commands.add_parser("demo", help="Run the demo cycle over every window size")
+demoParser.set_defaults(func=Demo)
+
+for sourceParser in [prepareParser, demoParser]:
+    sourceParser.add_argument("-r", "--rgb", type=dir_path, default="rgb", help="Set the path to the RGB files")
+    sourceParser.add_argument("-n", "--normal", type=dir_path, default="normal", help="Set the path to the normal maps")
+    sourceParser.add_argument("-m", "--max_images", type=int, default=10000, help="The maximum amount of training images to create")
+    sourceParser.add_argument("-j", "--workers", type=int, default=1, help="The number of processes used for tiling the images")
 
 if __name__ == "__main__":
     args = parser.parse_args()
@@ -74,14 +354,15 @@ if __name__ == "__main__":
         datefmt='%Y-%m-%d %H:%M:%S',
         level=logging.DEBUG)
 
-    if args.demo:
-        DemoCycle(args.workdir, args.rgb, args.normal, args.max_images)
-    elif args.file is not None:
-        generatorNetwork = NormalGeneratorNetwork(args.workdir, args.size)
-        if not generatorNetwork.IsModelExists():
-            logging.error("No model of {0} size exists!".format(args.size))
-            exit(1)
-        generatorNetwork.LoadModel()
-        imgBuilder = ImageBuilder(args.workdir, generatorNetwork, args.size)
-        imgBuilder.BuildSinglePicture(args.file)
-
+    if args.trace is not None:
+        Trace.Enable()
+    if args.memory_budget > 0:
+        Memory.SetLimit(args.memory_budget * 1024 * 1024)
+    try:
+        args.func(args)
+    finally:
+        if args.trace is not None:
+            Trace.ExportChromeTrace(args.trace)
+            summary = Trace.Summary()
+            logging.info("Stage timings:\n" + summary)
+            print(summary)